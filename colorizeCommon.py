@@ -0,0 +1,346 @@
+# Colorize Common by Timothy Halim
+#
+# Texture color sampling and shading network lookups shared by materialSwitch and textureSwitch
+#
+# Install:
+# - Copy this file to a folder in the maya script path (e.g. Documents/maya/scripts)
+#   before running materialSwitch or textureSwitch
+
+import os
+import re
+import json
+import time
+import hashlib
+from maya import cmds
+import maya.OpenMaya as om
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import OpenImageIO as oiio
+except ImportError:
+    oiio = None
+
+# File color spaces the disk mean can be brought to a linear sRGB rendering space from
+RAW_SPACES = ['raw', 'utility - raw']
+LINEAR_SPACES = ['scene-linear rec 709/srgb', 'scene-linear rec.709-srgb', 'linear srgb', 'linear rec 709 (srgb)', 
+                 'utility - linear - srgb', 'lin_srgb']
+SRGB_SPACES = ['srgb', 'srgb texture', 'utility - srgb - texture', 'srgb encoded rec.709 (srgb)', 'srgb_tx']
+
+def srgbToLinear(values):
+    # sRGB transfer curve decoded per value, applied to pixels before they are averaged
+    if np is not None:
+        values = np.asarray(values, dtype=np.float64)
+        return np.where(values <= 0.04045, values / 12.92, ((np.maximum(values, 0.04045) + 0.055) / 1.055) ** 2.4)
+    return [v / 12.92 if v <= 0.04045 else ((v + 0.055) / 1.055) ** 2.4 for v in values]
+
+def meanRGBA(values, channels=4):
+    # Mean of a flat list of interleaved channels, padded to RGBA with an opaque alpha
+    count = len(values) // channels
+    if not count:
+        return None
+    if np is not None:
+        mean = np.asarray(values, dtype=np.float64).reshape(count, channels).mean(axis=0).tolist()
+    else:
+        mean = [sum(values[c::channels]) / count for c in range(channels)]
+    if channels < 3:
+        mean = [mean[0]] * 3 + mean[1:]
+    return (list(mean) + [1.0])[:4]
+
+def readImageOIIO(path, size, space='raw'):
+    # Smallest mip level still at least size wide, scanlines streamed and decimated to about size x size
+    image = oiio.ImageInput.open(path)
+    if not image:
+        return None
+    try:
+        level = 0
+        while image.seek_subimage(0, level + 1):
+            spec = image.spec()
+            if spec.width < size or spec.height < size:
+                break
+            level += 1
+        image.seek_subimage(0, level)
+        spec = image.spec()
+        channels = min(spec.nchannels, 4)
+        step = max(1, min(spec.width, spec.height) // size)
+        
+        total = np.zeros(channels, dtype=np.float64)
+        count = 0
+        for y in range(spec.y, spec.y + spec.height, step):
+            row = image.read_scanline(y, spec.z, oiio.FLOAT)
+            if row is None:
+                return None
+            row = np.asarray(row, dtype=np.float64).reshape(-1, spec.nchannels)[::step, :channels]
+            if space == 'srgb':
+                colors = 3 if channels > 2 else 1
+                row[:, :colors] = srgbToLinear(row[:, :colors])
+            total += row.sum(axis=0)
+            count += len(row)
+        if not count:
+            return None
+        return meanRGBA((total / count).tolist(), channels)
+    finally:
+        image.close()
+
+def readImageMImage(path, size, space='raw'):
+    # Maya image reader, resized to size x size before the pixels are read
+    image = om.MImage()
+    image.readFromFile(path)
+    image.resize(size, size, False)
+    
+    util = om.MScriptUtil()
+    if image.pixelType() == om.MImage.kFloat:
+        pixels, getItem = image.floatPixels(), util.getFloatArrayItem
+        scale = 1.0
+    else:
+        pixels, getItem = image.pixels(), util.getUcharArrayItem
+        scale = 1.0 / 255
+    values = [getItem(pixels, i) * scale for i in range(size * size * 4)]
+    if space == 'srgb':
+        # Alpha is stored linear
+        for c in range(3):
+            values[c::4] = srgbToLinear(values[c::4])
+    return meanRGBA(values)
+
+def readImageMean(path, size=64, space='raw'):
+    # Mean RGBA of an image on disk, read at a reduced resolution
+    # OpenImageIO is mip and tile aware for .tx/.exr, MImage is the fallback
+    # space 'srgb' linearizes every pixel first, the mean of the encoded values is not the linear mean
+    if oiio is not None and np is not None:
+        try:
+            rgba = readImageOIIO(path, size, space)
+            if rgba:
+                return rgba
+        except:
+            pass
+    try:
+        return readImageMImage(path, size, space)
+    except:
+        return None
+
+def getFileTexturePath(node):
+    # Single image on disk behind a file node, None for udim, sequences or missing files
+    if cmds.nodeType(node) != 'file':
+        return None
+    if cmds.getAttr(node + '.uvTilingMode') or cmds.getAttr(node + '.useFrameExtension'):
+        return None
+    path = cmds.getAttr(node + '.fileTextureName') or ''
+    if path and not os.path.isabs(path):
+        path = cmds.workspace(expandName=path)
+    return path if os.path.isfile(path) else None
+
+def getFileColorSpace(node):
+    # How the file pixels reach the rendering space, 'raw' unchanged, 'srgb' decoded, None when only Maya can convert them
+    if not cmds.colorManagementPrefs(q=True, cmEnabled=True):
+        return 'raw'
+    space = (cmds.getAttr(node + '.colorSpace') or '').lower()
+    rendering = (cmds.colorManagementPrefs(q=True, renderingSpaceName=True) or '').lower()
+    if space == rendering or space in RAW_SPACES:
+        return 'raw'
+    if rendering not in LINEAR_SPACES:
+        return None
+    if space in LINEAR_SPACES:
+        return 'raw'
+    if space in SRGB_SPACES:
+        return 'srgb'
+    return None
+
+def isWholeImageMapping(node):
+    # The uv square shows the whole image a whole number of times, so its mean is the image mean
+    if cmds.getAttr(node + '.alphaIsLuminance'):
+        return False
+    # Exposure is applied by Maya before the color balance, only colorAtPoint accounts for it
+    if cmds.attributeQuery('exposure', node=node, exists=True) and cmds.getAttr(node + '.exposure'):
+        return False
+    sources = cmds.listConnections(node + '.uvCoord', s=True, d=False) or []
+    for place in sources:
+        if cmds.nodeType(place) != 'place2dTexture':
+            return False
+        get = lambda attr: cmds.getAttr(place + '.' + attr)
+        if list(get('coverage')[0]) != [1.0, 1.0] or get('rotateFrame') or get('rotateUV'):
+            return False
+        if list(get('noiseUV')[0]) != [0.0, 0.0]:
+            return False
+        repeat = list(get('repeatUV')[0])
+        if any(value != int(value) for value in repeat):
+            return False
+        # Repeats and shifts only tile the image again when both directions wrap
+        if not (get('wrapU') and get('wrapV')) and (repeat != [1.0, 1.0] or any(get('offset')[0]) or any(get('translateFrame')[0])):
+            return False
+    return True
+
+def sampleTextureMean(source, samples=10):
+    # Mean color over a samples x samples uv grid, evaluated in a single colorAtPoint call
+    u = [float(x)/samples for x in range(samples) for y in range(samples)]
+    v = [float(y)/samples for x in range(samples) for y in range(samples)]
+    return meanRGBA(cmds.colorAtPoint(source, o='RGBA', u=u, v=v))
+
+def getTextureColor(source, samples=10, size=64, cache=None):
+    # Mean color of a texture output, file images are read from disk and procedurals sampled
+    # the image mean is cached by file content, procedurals have no file to key on
+    # the disk mean is only used when it matches what Maya renders, otherwise colorAtPoint does the conversion
+    node = source.split('.')[0]
+    path = getFileTexturePath(node)
+    space = getFileColorSpace(node) if path else None
+    rgba = None
+    if path and space and isWholeImageMapping(node):
+        key = cache.key(path, size=size, space=space) if cache else None
+        rgba = cache.get(key) if cache else None
+        if rgba is None:
+            rgba = readImageMean(path, size, space)
+            if rgba is not None and cache:
+                cache.set(key, rgba)
+    if rgba is None:
+        return sampleTextureMean(source, samples)
+    
+    # Invert and color gain/offset are per channel, so they apply to the mean directly
+    if cmds.getAttr(node + '.invert'):
+        rgba = [1 - c for c in rgba[:3]] + rgba[3:]
+    gain = list(cmds.getAttr(node + '.colorGain')[0]) + [cmds.getAttr(node + '.alphaGain')]
+    offset = list(cmds.getAttr(node + '.colorOffset')[0]) + [cmds.getAttr(node + '.alphaOffset')]
+    return [c * g + o for c, g, o in zip(rgba, gain, offset)]
+
+class TextureColorCache(object):
+    # Colors on disk keyed by a digest of the texture path, its mtime/size and the sampling parameters
+    # the same file is used by materialSwitch and textureSwitch, least recently used entries go above maxEntries
+    def __init__(self, path=None, maxEntries=5000):
+        self.path = path
+        self.maxEntries = maxEntries
+        self.entries = None
+        self.dirty = False
+        
+    def getPath(self):
+        if not self.path:
+            self.path = os.path.join(cmds.internalVar(userAppDir=True), 'colorizeTextureCache.json').replace("\\", "/")
+        return self.path
+        
+    def read(self):
+        if os.path.isfile(self.getPath()):
+            try:
+                with open(self.getPath(), "r") as f:
+                    return json.load(f)
+            except:
+                pass
+        return {}
+        
+    def load(self, force=False):
+        if self.entries is None or force:
+            self.entries = self.read()
+            self.dirty = False
+        return self.entries
+        
+    def key(self, path, **params):
+        stat = os.stat(path)
+        data = json.dumps([os.path.normcase(os.path.abspath(path)), stat.st_mtime, stat.st_size, params], sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+        
+    def get(self, key):
+        entry = self.load().get(key)
+        if entry is None:
+            return None
+        entry['used'] = time.time()
+        self.dirty = True
+        return list(entry['rgba'])
+        
+    def set(self, key, rgba):
+        self.load()[key] = {'rgba': list(rgba), 'used': time.time()}
+        self.dirty = True
+        
+    def save(self):
+        if not self.dirty:
+            return
+        # Merge what the other tool wrote meanwhile, newest use wins
+        entries = self.read()
+        for key, entry in self.load().items():
+            if key not in entries or entries[key]['used'] < entry['used']:
+                entries[key] = entry
+        if len(entries) > self.maxEntries:
+            for key in sorted(entries, key=lambda k: entries[k]['used'])[:len(entries) - self.maxEntries]:
+                del entries[key]
+        
+        cacheDir = os.path.dirname(self.getPath())
+        if cacheDir and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        with open(self.getPath(), "w") as f:
+            json.dump(entries, f)
+        self.entries = entries
+        self.dirty = False
+
+textureColorCache = TextureColorCache()
+
+class ShadingGraphIndex(object):
+    # Shading networks queried from the DG once per operation, then walked with dict and set lookups
+    # mesh -> shadingEngine, and shadingEngine -> material -> texture connections
+    def __init__(self, shadingEngines=[]):
+        self.upstream = {}
+        self.materials = set()
+        self.textures = set()
+        self.textureConnections = {}
+        self.networks = {}
+        if shadingEngines:
+            self.addShadingEngines(shadingEngines)
+        
+    @staticmethod
+    def getShadingEngines(meshes):
+        # First shading engine of every mesh, in a single listConnections call
+        # instances share their shape, each transform is matched by its instObjGroups element
+        paths = {}
+        instances = {}
+        for obj in meshes:
+            shape = obj.getShape()
+            shapePaths = [path.name() for path in shape.getAllPaths()]
+            if shapePaths[0] not in instances:
+                instances[shapePaths[0]] = {}
+                for path in shapePaths:
+                    paths[path] = shapePaths[0]
+            instances[shapePaths[0]].setdefault(shape.instanceNumber(), obj)
+        result = {}
+        connections = cmds.listConnections(list(instances), type='shadingEngine', c=True) or []
+        for plug, sg in zip(connections[::2], connections[1::2]):
+            match = re.search(r'\.instObjGroups\[(\d+)\]', plug)
+            shape = paths.get(plug.split('.')[0])
+            if not match or shape is None:
+                continue
+            obj = instances[shape].get(int(match.group(1)))
+            if obj is not None and obj not in result:
+                result[obj] = sg
+        return result
+        
+    def addShadingEngines(self, shadingEngines):
+        history = cmds.listHistory(shadingEngines) or []
+        self.materials.update(cmds.ls(history, materials=True) or [])
+        self.textures.update(cmds.ls(history, textures=True) or [])
+        connections = cmds.listConnections(history, s=True, d=False, c=True, p=True) or []
+        for destination, source in zip(connections[::2], connections[1::2]):
+            destinationNode, sourceNode = destination.split('.')[0], source.split('.')[0]
+            self.upstream.setdefault(destinationNode, set()).add(sourceNode)
+            if sourceNode in self.textures and destinationNode in self.materials:
+                self.textureConnections.setdefault(destinationNode, []).append((source, destination))
+        self.networks = {}
+        
+    def getNetwork(self, sg):
+        # Every node upstream of the shading engine
+        if sg not in self.networks:
+            network = set()
+            pending = [sg]
+            while pending:
+                node = pending.pop()
+                for source in self.upstream.get(node, ()):
+                    if source not in network:
+                        network.add(source)
+                        pending.append(source)
+            self.networks[sg] = network
+        return self.networks[sg]
+        
+    def getMaterials(self, sg):
+        return self.materials.intersection(self.getNetwork(sg))
+        
+    def getTextureConnections(self, sg):
+        # (texture plug, material plug) pairs of the shading engine
+        result = []
+        for material in sorted(self.getMaterials(sg)):
+            result += self.textureConnections.get(material, [])
+        return result
@@ -5,6 +5,7 @@
 # and store the original connection data in a json file that can be used to restore it later
 #
 # Install:
+# - Copy colorizeCommon.py to a folder in the maya script path (e.g. Documents/maya/scripts)
 # - Copy and paste content to maya script editor, and run it from there
 # - Or use type "execfile('[path to this file]')" in script editor and run it
 #
@@ -21,8 +22,11 @@ import os
 import json
 import traceback
 from PySide2.QtWidgets import QApplication, QDialog, QVBoxLayout, QPushButton, QCheckBox, QListWidget
+from maya import cmds
 import pymel.core as pm
 
+from colorizeCommon import getTextureColor, textureColorCache, ShadingGraphIndex
+
 def undoOn(function):
     def funcCall(*args,**kwargs):
         result = None
@@ -140,123 +144,102 @@ class ColorizeTool(QDialog):
     def processData(self):
         self.shaderData = {}
         shadingGroup = []
+        textureColorCache.load(force=True)
 
+        shadingEngines = ShadingGraphIndex.getShadingEngines(self.meshes)
         for obj in self.meshes:
-            shadingEngines = pm.listConnections(obj.getShape(), type='shadingEngine')
-            if not shadingEngines:
+            objShadingGroup = shadingEngines.get(obj)
+            if not objShadingGroup:
                 continue
             
-            objShadingGroup = shadingEngines[0]
-            if objShadingGroup not in shadingGroup:
+            if objShadingGroup not in self.shaderData:
                 shadingGroup.append(objShadingGroup)
-            
-            currentData = self.shaderData.get(objShadingGroup.name(), {'objects':[], 'flatShader':None})
-            currentData['objects'] += [obj.name()]
-            self.shaderData[objShadingGroup.name()] = currentData
+                self.shaderData[objShadingGroup] = {'objects':[], 'flatShader':None}
+            self.shaderData[objShadingGroup]['objects'].append(obj.name())
             
         for sg in shadingGroup:
-            currentData = self.shaderData[sg.name()]
-            if currentData['flatShader'] is None:
-                shaderExist = pm.ls(sg.name()+"_flat")
-                if shaderExist:
-                    pm.delete(pm.listHistory(shaderExist[0]))
-                currentData['flatShader'] = pm.duplicate(sg, upstreamNodes=True, name=sg.name()+"_flat", rr=True)[0].name()
-
-                sgConnections = pm.listHistory(currentData['flatShader'])
-                sgTextures = pm.ls(sgConnections, textures=True)
-                sgShaders = pm.ls(sgConnections, materials=True)
+            shaderExist = pm.ls(sg+"_flat")
+            if shaderExist:
+                pm.delete(pm.listHistory(shaderExist[0]))
+            self.shaderData[sg]['flatShader'] = pm.duplicate(sg, upstreamNodes=True, name=sg+"_flat", rr=True)[0].name()
+        
+        # Flat networks are fresh duplicates, indexed together once they all exist
+        flatIndex = ShadingGraphIndex([self.shaderData[sg]['flatShader'] for sg in shadingGroup])
+        for sg in shadingGroup:
+            textures = set()
+            for source, destination in flatIndex.getTextureConnections(self.shaderData[sg]['flatShader']):
+                rgba = getTextureColor(source, cache=textureColorCache)
                 
-                for texture in sgTextures:
-                    connections = pm.listConnections(texture, connections=True, destination=True, plugs=True)
+                # pump up saturation
+                saturation = .8
+                iMax = rgba.index(max(rgba[0:3]))
+                iMin = rgba.index(min(rgba[0:3]))
+                if iMax != iMin:
+                    iMid = next((i for i in range(3) if i != iMax and i != iMin), 0)
+                    ratio = (rgba[iMax] - rgba[iMin])/rgba[iMax]
+                    rgba[iMax] = rgba[iMax]
+                    rgba[iMin] = rgba[iMin] * (1-saturation)
+                    newRatio = (rgba[iMax] - rgba[iMin])/rgba[iMax]
+                    rgba[iMid] = rgba[iMid] * ((1-saturation)-(ratio-newRatio))
                     
-                    for connection in connections:
-                        source = connection[0]
-                        destination = connection[1]
-                        if destination.node() in sgShaders:
-                            rgba = [0,0,0,0]
-                            maxSample = 10
-                            
-                            for u in range(maxSample):
-                                for v in range(maxSample):
-                                    x = float(u)/maxSample
-                                    y = float(v)/maxSample
-                                    total = maxSample*maxSample
-                                    
-                                    r,g,b,a = pm.colorAtPoint(source, o='RGBA', u=x, v=y)
-                                    
-                                    rgba[0] += r/total
-                                    rgba[1] += g/total
-                                    rgba[2] += b/total
-                                    rgba[3] += a/total
-                            
-                            # pump up saturation
-                            saturation = .8
-                            iMax = rgba.index(max(rgba[0:3]))
-                            iMin = rgba.index(min(rgba[0:3]))
-                            if iMax != iMin:
-                                iMid = next((i for i in range(3) if i != iMax and i != iMin), 0)
-                                ratio = (rgba[iMax] - rgba[iMin])/rgba[iMax]
-                                rgba[iMax] = rgba[iMax]
-                                rgba[iMin] = rgba[iMin] * (1-saturation)
-                                newRatio = (rgba[iMax] - rgba[iMin])/rgba[iMax]
-                                rgba[iMid] = rgba[iMid] * ((1-saturation)-(ratio-newRatio))
-                                
-                            pm.disconnectAttr(source, destination=destination)
-                            pm.setAttr(destination, rgba[0], rgba[1], rgba[2], type='double3')
-                            pm.delete(pm.listHistory(source.node()))
+                pm.disconnectAttr(source, destination=destination)
+                pm.setAttr(destination, rgba[0], rgba[1], rgba[2], type='double3')
+                textures.add(source.split('.')[0])
+            
+            # Textures go once all of their connections are replaced
+            if textures:
+                pm.delete(pm.listHistory(list(textures)))
 
+        textureColorCache.save()
         jsonOutput = self.getJsonFile()
         with open(jsonOutput, "w+") as f:
             f.write(json.dumps(self.shaderData, indent=4))
+        self.shaderDataStamp = None
             
         self.checkJson()
     
-    @undoOn
-    def colorize(self):
+    def loadShaderData(self):
+        # Json is only read again when the file changed since the last load
         jsonOutput = self.getJsonFile()
-        if os.path.isfile(jsonOutput):
+        if not os.path.isfile(jsonOutput):
+            raise Exception(jsonOutput +" is missing")
+        stamp = (jsonOutput, os.path.getmtime(jsonOutput), os.path.getsize(jsonOutput))
+        if getattr(self, 'shaderDataStamp', None) != stamp:
             with open(jsonOutput, "r+") as f:
                 self.shaderData = json.load(f)
-
-            for k, v in self.shaderData.items():
-                originalShader = pm.ls(k)
-                if originalShader:
-                    originalShader = originalShader[0]
-
-                flatShader = pm.ls(v['flatShader'])
-                if flatShader:
-                    flatShader = flatShader[0]
-                
-                if flatShader and originalShader:
-                    objects = pm.ls(v['objects'])
-                    pm.sets(originalShader, e=True, remove=objects)
-                    pm.sets(flatShader, e=True, forceElement=objects)
-                    
-        else:
-            raise Exception(jsonOutput +" is missing")
+            self.shaderDataStamp = stamp
+        return self.shaderData
+    
+    def switchShader(self, flat=True):
+        # Move only the shapes not already in the target shading group, one forceElement per group
+        moves = {}
+        for k, v in self.loadShaderData().items():
+            source, target = (k, v['flatShader']) if flat else (v['flatShader'], k)
+            if not v['flatShader'] or not cmds.objExists(source) or not cmds.objExists(target):
+                continue
+            
+            objects = cmds.ls(v['objects'], long=True)
+            if not objects:
+                continue
+            shapes = cmds.listRelatives(objects, s=True, ni=True, f=True) or []
+            # Whole object members only, a shape with some faces assigned still has to move
+            members = [m for m in cmds.sets(target, q=True) or [] if '.' not in m]
+            members = set(cmds.ls(members, long=True) or []) if members else set()
+            pending = [shape for shape in shapes if shape not in members]
+            if pending:
+                moves.setdefault(target, []).extend(pending)
+        
+        for target, shapes in moves.items():
+            cmds.sets(shapes, e=True, forceElement=target)
+        return moves
+    
+    @undoOn
+    def colorize(self):
+        self.switchShader(flat=True)
     
     @undoOn
     def restore(self):
-        jsonOutput = self.getJsonFile()
-        if os.path.isfile(jsonOutput):
-            with open(jsonOutput, "r+") as f:
-                self.shaderData = json.load(f)
-
-            for k, v in self.shaderData.items():
-                originalShader = pm.ls(k)
-                if originalShader:
-                    originalShader = originalShader[0]
-
-                flatShader = pm.ls(v['flatShader'])
-                if flatShader:
-                    flatShader = flatShader[0]
-                
-                if flatShader and originalShader:
-                    objects = pm.ls(v['objects'])
-                    pm.sets(flatShader, e=True, remove=objects)
-                    pm.sets(originalShader, e=True, forceElement=objects)
-        else:
-            raise Exception(jsonOutput +" is missing")
+        self.switchShader(flat=False)
     
     @undoOn
     def delete(self):
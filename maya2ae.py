@@ -15,8 +15,15 @@ except:
     from PySide.QtCore import *
 
 import os
-import subprocess
+import json
+import bisect
 import math
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 from maya import cmds, mel
 import maya.OpenMaya as om
@@ -80,14 +87,334 @@ class SearchBox(QLineEdit):
         self.completer.setCompletionMode(QCompleter.PopupCompletion)
         self.completer.setCaseSensitivity(Qt.CaseInsensitive)
         self.setCompleter(self.completer)
+        self.autocomplete_model = QStandardItemModel(self)
+        self.completer.setModel(self.autocomplete_model)
         self.updateCompletionList(completerContents)
         
     def updateCompletionList(self, autocomplete_list):
-        self.autocomplete_model = QStandardItemModel()
+        self.autocomplete_model.clear()
         for text in autocomplete_list:
             self.autocomplete_model.appendRow(QStandardItem(text))
-        self.completer.setModel(self.autocomplete_model)
+            
+    def insertCompletion(self, row, text):
+        self.autocomplete_model.insertRow(row, QStandardItem(text))
+        
+    def removeCompletion(self, row):
+        self.autocomplete_model.removeRow(row)
+        
+
+class AEFinder(QThread):
+    # Look for After Effects installs without blocking the main thread
+    found = Signal(str, list)
+    
+    def __init__(self, adobeDir, aeExe, parent=None):
+        super(AEFinder, self).__init__(parent)
+        self.adobeDir = adobeDir
+        self.aeExe = aeExe
+        
+    def run(self):
+        afterEffects = []
+        if os.path.isdir(self.adobeDir):
+            afterEffects = [ae for ae in sorted(os.listdir(self.adobeDir)) if 'After Effects' in ae and os.path.exists(os.path.join(self.adobeDir, ae, self.aeExe).replace('\\', '/'))]
+        self.found.emit(self.adobeDir, afterEffects)
+
+class AEJob(QObject):
+    # One After Effects script run, launched detached and finished by the marker file the JSX writes
+    # AfterFX.exe -r becomes After Effects itself when it is not running, so its exit says nothing
+    finished = Signal(object)
+    
+    def __init__(self, aePath, jsx, parent=None, timeout=15*60):
+        super(AEJob, self).__init__(parent)
+        self.aePath = aePath
+        self.jsx = jsx
+        self.marker = getAEMarkerPath(jsx)
+        self.state = 'queued'
+        self.result = None
+        self.timeout = timeout
+        self.startTime = None
+        
+        self.timer = QTimer(self)
+        self.timer.setInterval(500)
+        self.timer.timeout.connect(self.poll)
+        
+    def start(self):
+        if os.path.isfile(self.marker):
+            os.remove(self.marker)
+        started = QProcess.startDetached(self.aePath, ['-r', self.jsx])
+        if isinstance(started, tuple):
+            started = started[0]
+        if not started:
+            self.finish('failed', 'could not start %s' %self.aePath)
+            return
+        self.state = 'launched'
+        self.startTime = time.time()
+        self.timer.start()
+        
+    def poll(self):
+        if os.path.isfile(self.marker):
+            try:
+                with open(self.marker, 'r') as f:
+                    result = f.read().strip()
+                os.remove(self.marker)
+            except (IOError, OSError):
+                # Still being written, read it on the next poll
+                return
+            self.finish('done' if result == 'ok' else 'failed', result)
+        elif time.time() - self.startTime > self.timeout:
+            self.finish('timeout', 'no result after %d seconds' %self.timeout)
+            
+    def finish(self, state, result):
+        self.timer.stop()
+        self.state = state
+        self.result = result
+        self.finished.emit(self)
+
+class AEJobQueue(QObject):
+    # Run After Effects imports one after another, the next one starts once the previous script reported back
+    jobFinished = Signal(object)
+    
+    def __init__(self, parent=None):
+        super(AEJobQueue, self).__init__(parent)
+        self.jobs = []
+        self.current = None
+        
+    def add(self, aePath, jsx):
+        job = AEJob(aePath, jsx, self)
+        job.finished.connect(self.onJobFinished)
+        self.jobs.append(job)
+        self.next()
+        return job
+        
+    def pending(self):
+        return [job for job in self.jobs if job.state in ('queued', 'launched')]
+        
+    def next(self):
+        if self.current is not None:
+            return
+        queued = [job for job in self.jobs if job.state == 'queued']
+        if queued:
+            self.current = queued[0]
+            self.current.start()
+            
+    def onJobFinished(self, job):
+        print ("AE import %s : %s, %s" %(job.jsx, job.state, job.result))
+        self.jobs.remove(job)
+        if job is self.current:
+            self.current = None
+        self.jobFinished.emit(job)
+        self.next()
+
+class ExportListModel(object):
+    # Keep the export list in sync from node added, removed and renamed messages
+    # events are queued and applied together once the burst is over
+    def __init__(self, listWidget, attribute='toAE', delay=100):
+        self.listWidget = listWidget
+        self.attribute = attribute
+        self.nodes = {}
+        self.added = []
+        self.removed = set()
+        self.renamed = False
+        self.callbacks = []
+        
+        self.timer = QTimer(listWidget)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.flush)
+        
+    def registerCallbacks(self):
+        if self.callbacks:
+            return
+        self.callbacks = [
+            om.MDGMessage.addNodeAddedCallback(self.nodeAdded, 'transform'),
+            om.MDGMessage.addNodeRemovedCallback(self.nodeRemoved, 'transform'),
+            om.MNodeMessage.addNameChangedCallback(om.MObject(), self.nameChanged),
+            om.MDagMessage.addParentAddedCallback(self.parentChanged),
+            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterOpen, self.sceneChanged),
+            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterNew, self.sceneChanged),
+        ]
+        
+    def removeCallbacks(self):
+        for cb in self.callbacks:
+            om.MMessage.removeCallback(cb)
+        self.callbacks = []
+        self.timer.stop()
+        
+    def sceneChanged(self, *args):
+        self.timer.stop()
+        self.reset()
+        
+    def nodeAdded(self, node, *args):
+        # The attribute is added after creation, it is checked when the queue is applied
+        self.added.append(om.MObjectHandle(node))
+        self.timer.start()
+        
+    def nodeRemoved(self, node, *args):
+        key = om.MObjectHandle(node).hashCode()
+        if key in self.nodes:
+            self.removed.add(key)
+            self.timer.start()
+        
+    def nameChanged(self, node, *args):
+        # Renaming an ancestor changes the partial path of the tracked nodes below it
+        if self.nodes and node.hasFn(om.MFn.kDagNode):
+            self.renamed = True
+            self.timer.start()
+            
+    def parentChanged(self, child, parent, *args):
+        if self.nodes:
+            self.renamed = True
+            self.timer.start()
+            
+    def getNodeName(self, node):
+        if node.hasFn(om.MFn.kDagNode):
+            return om.MFnDagNode(node).partialPathName()
+        return om.MFnDependencyNode(node).name()
+        
+    def reset(self):
+        # Full scan, only used on explicit refresh
+        self.added = []
+        self.removed = set()
+        self.renamed = False
+        self.nodes = {}
+        for node in cmds.ls("::*.%s" %self.attribute, o=True):
+            handle = om.MObjectHandle(getDependNode(node))
+            self.nodes[handle.hashCode()] = (handle, self.getNodeName(handle.object()))
+        self.updateWidget()
+        
+    def flush(self):
+        for handle in self.added:
+            if handle.isValid() and handle.hashCode() not in self.removed:
+                node = handle.object()
+                if om.MFnDependencyNode(node).hasAttribute(self.attribute):
+                    self.nodes[handle.hashCode()] = (handle, self.getNodeName(node))
+        for key in self.removed:
+            self.nodes.pop(key, None)
+        # Nodes deleted without a message, e.g. by undo, are dropped here
+        for key, (handle, name) in list(self.nodes.items()):
+            if not handle.isValid():
+                del self.nodes[key]
+            elif self.renamed:
+                self.nodes[key] = (handle, self.getNodeName(handle.object()))
+        self.added = []
+        self.removed = set()
+        self.renamed = False
+        self.updateWidget()
+        
+    def updateWidget(self):
+        # Only remove and insert the items that differ
+        names = sorted(name for handle, name in self.nodes.values())
+        nameSet = set(names)
+        for row in reversed(range(self.listWidget.count())):
+            if self.listWidget.item(row).text() not in nameSet:
+                self.listWidget.takeItem(row)
+        current = set(self.listWidget.item(row).text() for row in range(self.listWidget.count()))
+        for row, name in enumerate(names):
+            if name not in current:
+                self.listWidget.insertItem(row, name)
+
+class ExportPathIndex(object):
+    # Sorted, deduplicated export path suggestions, only the reference or
+    # alembic node that changed is processed and the completer is edited in place
+    def __init__(self, searchBox, delay=100):
+        self.searchBox = searchBox
+        self.sources = {}
+        self.owners = {}
+        self.paths = []
+        self.pending = []
+        self.callbacks = []
+        
+        self.timer = QTimer(searchBox)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(delay)
+        self.timer.timeout.connect(self.flush)
+        
+    def registerCallbacks(self):
+        if self.callbacks:
+            return
+        self.callbacks = [
+            om.MSceneMessage.addReferenceCallback(om.MSceneMessage.kAfterCreateReference, self.referenceLoaded),
+            om.MSceneMessage.addReferenceCallback(om.MSceneMessage.kAfterLoadReference, self.referenceLoaded),
+            om.MSceneMessage.addReferenceCallback(om.MSceneMessage.kBeforeRemoveReference, self.referenceRemoved),
+            om.MDGMessage.addNodeAddedCallback(self.alembicAdded, 'AlembicNode'),
+            om.MDGMessage.addNodeRemovedCallback(self.nodeRemoved, 'AlembicNode'),
+            # References of the previous scene go without kBeforeRemoveReference
+            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterOpen, self.sceneChanged),
+            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterNew, self.sceneChanged),
+        ]
         
+    def removeCallbacks(self):
+        for cb in self.callbacks:
+            om.MMessage.removeCallback(cb)
+        self.callbacks = []
+        self.timer.stop()
+        
+    def sceneChanged(self, *args):
+        self.timer.stop()
+        self.reset()
+        
+    def addPath(self, key, path):
+        self.removePath(key)
+        self.sources[key] = path
+        owners = self.owners.setdefault(path, set())
+        owners.add(key)
+        if len(owners) == 1:
+            row = bisect.bisect_left(self.paths, path)
+            self.paths.insert(row, path)
+            self.searchBox.insertCompletion(row, path)
+            
+    def removePath(self, key):
+        path = self.sources.pop(key, None)
+        if path is None:
+            return
+        owners = self.owners[path]
+        owners.discard(key)
+        if not owners:
+            del self.owners[path]
+            row = bisect.bisect_left(self.paths, path)
+            del self.paths[row]
+            self.searchBox.removeCompletion(row)
+            
+    def referenceLoaded(self, node, fileObject, *args):
+        key = om.MObjectHandle(node).hashCode()
+        self.addPath(key, os.path.dirname(fileObject.resolvedFullName()))
+        
+    def referenceRemoved(self, node, fileObject, *args):
+        self.removePath(om.MObjectHandle(node).hashCode())
+        
+    def alembicAdded(self, node, *args):
+        # abc_File is set after the node is created, read it once the burst is over
+        self.pending.append(om.MObjectHandle(node))
+        self.timer.start()
+        
+    def nodeRemoved(self, node, *args):
+        self.removePath(om.MObjectHandle(node).hashCode())
+        
+    def flush(self):
+        for handle in self.pending:
+            if handle.isValid():
+                abcFile = om.MFnDependencyNode(handle.object()).findPlug('abc_File', False).asString()
+                if abcFile:
+                    self.addPath(handle.hashCode(), os.path.dirname(abcFile))
+        self.pending = []
+        
+    def reset(self):
+        # Full scan, when the tool opens and after a scene is opened or created
+        self.sources = {}
+        self.owners = {}
+        self.paths = []
+        self.pending = []
+        self.searchBox.updateCompletionList([])
+        self.addPath('workspace', cmds.workspace(q=1, rd=1)+'data')
+        for ref in cmds.ls(type='reference'):
+            try:
+                refFile = cmds.referenceQuery(ref, filename=True, withoutCopyNumber=True)
+            except:
+                continue
+            self.addPath(om.MObjectHandle(getDependNode(ref)).hashCode(), os.path.dirname(refFile))
+        for abc in cmds.ls(type="AlembicNode"):
+            abcFile = cmds.getAttr(abc+'.abc_File')
+            if abcFile:
+                self.addPath(om.MObjectHandle(getDependNode(abc)).hashCode(), os.path.dirname(abcFile))
 
 class MAYA2AE( QMainWindow ):
     def __init__( self, parent=None ):
@@ -163,6 +490,12 @@ class MAYA2AE( QMainWindow ):
         self.bakeCamera = QCheckBox('Bake Renderable Camera')
         self.bakeFixFocalLength = QCheckBox('Fix Camera Focal Length')
         
+        self.bakeSimplifyLayout = QHBoxLayout()
+        self.bakeSimplify = QCheckBox('Simplify Keys, Tolerance Scale')
+        self.bakeTolerance = QDoubleSpinBox()
+        for w in [self.bakeSimplify, self.bakeTolerance]:
+            self.bakeSimplifyLayout.addWidget(w)
+        
         self.bakeOptionLayout = QHBoxLayout()
         self.bakeLabel = QLabel('Bake')
         self.bakeTranslate = QCheckBox('Translate')
@@ -174,7 +507,7 @@ class MAYA2AE( QMainWindow ):
         
         self.bakeButton = QPushButton('Bake Selection')
         
-        for w in [self.bakeFrameLayout, self.bakeFullPath, self.bakeCamera, self.bakeFixFocalLength, self.bakeOptionLayout, self.bakeButton]:
+        for w in [self.bakeFrameLayout, self.bakeFullPath, self.bakeCamera, self.bakeFixFocalLength, self.bakeSimplifyLayout, self.bakeOptionLayout, self.bakeButton]:
             try:
                 self.bakeLayout.addWidget(w)
             except:
@@ -190,10 +523,12 @@ class MAYA2AE( QMainWindow ):
         for w in [self.exportListLabel]:
             self.exportListLayout.addWidget(w)
         self.exportList = QListWidget()
+        self.exportListModel = ExportListModel(self.exportList)
         
         self.exportPathLayout = QHBoxLayout()
         self.exportPathLabel = QLabel('Export Path :')
         self.exportPath = SearchBox()
+        self.exportPathIndex = ExportPathIndex(self.exportPath)
         for w in [self.exportPathLabel, self.exportPath]:
             self.exportPathLayout.addWidget(w)
         
@@ -225,6 +560,7 @@ class MAYA2AE( QMainWindow ):
             self.exportStartFrameLayout.addWidget(w)
 
         self.exportToMM = QCheckBox('Change Units to mm')
+        self.exportDirect = QCheckBox('Write Keyframes to JSX (skip .ma)')
         self.deleteUnknown = QCheckBox('Delete Unknown Node')
         self.deleteBaked = QCheckBox('Delete Baked after Export')
         self.deleteAfterImport = QCheckBox('Delete .JSX and .MA after AE import')
@@ -234,7 +570,7 @@ class MAYA2AE( QMainWindow ):
         for w in [
             self.exportListLayout, self.exportList, 
             self.exportPathLayout, self.exportCompLayout, self.exportFPSLayout, self.exportStartFrameLayout,
-            self.exportResolutionLayout, self.exportToMM, self.deleteUnknown, self.deleteBaked,  self.deleteAfterImport, self.exportButton
+            self.exportResolutionLayout, self.exportToMM, self.exportDirect, self.deleteUnknown, self.deleteBaked,  self.deleteAfterImport, self.exportButton
         ]:
             try:
                 self.exportLayout.addWidget(w)
@@ -244,7 +580,14 @@ class MAYA2AE( QMainWindow ):
     
     def initUI(self):
         self.adobePath.setText("C:\Program Files\Adobe")
-        self.adobePath.textChanged.connect(self.checkAE)
+        self.aeExe = "Support Files/AfterFX.exe"
+        self.aeFinders = []
+        self.aeSearchTimer = QTimer(self)
+        self.aeSearchTimer.setSingleShot(True)
+        self.aeSearchTimer.setInterval(300)
+        self.aeSearchTimer.timeout.connect(self.checkAE)
+        self.adobePath.textChanged.connect(self.aeSearchTimer.start)
+        aeJobQueue.jobFinished.connect(self.aeJobFinished)
         self.AELabel.setMaximumWidth(70)
         self.AELabel.setMinimumWidth(70)
         
@@ -258,6 +601,16 @@ class MAYA2AE( QMainWindow ):
         self.bakeFrameDiv.setAlignment(Qt.AlignCenter)
         
         self.bakeFixFocalLength.setChecked(True)
+        self.bakeTolerance.setDecimals(2)
+        self.bakeTolerance.setMinimum(0.01)
+        self.bakeTolerance.setMaximum(100)
+        self.bakeTolerance.setSingleStep(0.1)
+        self.bakeTolerance.setValue(1.0)
+        self.bakeTolerance.setToolTip(
+            'Multiplies the tolerance of each channel type : \n' + 
+            '\n'.join('%s %g %s' %(k, v, SIMPLIFY_UNITS[k]) for k, v in sorted(SIMPLIFY_TOLERANCES.items())))
+        self.bakeTolerance.setEnabled(False)
+        self.bakeSimplify.toggled.connect(self.bakeTolerance.setEnabled)
         self.bakeTranslate.setChecked(True)
         self.bakeRotate.setChecked(True)
         self.deleteUnknown.setChecked(True)
@@ -297,6 +650,7 @@ class MAYA2AE( QMainWindow ):
         self.exportStartFrame.setValue(1)
 
         self.exportToMM.setChecked(True)
+        self.exportDirect.setChecked(True)
         self.exportButton.clicked.connect(self.export2ae)
         
         #connect outliner
@@ -316,51 +670,58 @@ class MAYA2AE( QMainWindow ):
         self.scriptJobs = [
             cmds.scriptJob( event =["playbackRangeSliderChanged", self.refreshFrameRange], compressUndo=True, protected=True ),
             cmds.scriptJob( event =["playbackRangeChanged", self.refreshFrameRange], compressUndo=True, protected=True ),
-            cmds.scriptJob( conditionTrue=["delete", self.refreshExportList], compressUndo=True,  protected=True ),
-            cmds.scriptJob( event=["NameChanged", self.refreshExportList], compressUndo=True,  protected=True ),
-            cmds.scriptJob( event=["Undo", self.refreshExportList], compressUndo=True,  protected=True ),
-            cmds.scriptJob( event=["Redo", self.refreshExportList], compressUndo=True,  protected=True )
         ] 
-        self.referencesCallback = [
-            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterCreateReference, self.getAllPaths),
-            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterLoadReference, self.getAllPaths),
-            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterRemoveReference, self.getAllPaths),
-            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterUnloadReference, self.getAllPaths),
-            om.MSceneMessage.addCallback(om.MSceneMessage.kAfterImport, self.getAllPaths),
-        ]
+        self.exportListModel.registerCallbacks()
+        self.exportPathIndex.registerCallbacks()
         
     def unregisterScriptJobs(self):
         # Clean up the script job stuff prior to closing the dialog.
         for job in self.scriptJobs:
             cmds.scriptJob( kill=job, force=True )
-        for cb in self.referencesCallback:
-            om.MMessage.removeCallback(cb)
+        self.exportPathIndex.removeCallbacks()
+        self.exportListModel.removeCallbacks()
         
     def getAllPaths(self, *args, **kwargs):
-        paths = [cmds.workspace(q=1, rd=1)+'data'] 
-        paths += list(set([os.path.dirname(f) for f in cmds.file(q=1, r=1)]))
-        paths += list(set([os.path.dirname(cmds.getAttr(o+'.abc_File')) for o in cmds.ls(type="AlembicNode", ap=True)]))
-        paths.sort()
-        self.exportPath.updateCompletionList(paths)
+        self.exportPathIndex.reset()
         
     def closeEvent( self, event ):
         self.unregisterScriptJobs()
+        aeJobQueue.jobFinished.disconnect(self.aeJobFinished)
+        for finder in list(self.aeFinders):
+            finder.wait()
         try:
             super( MAYA2AE, self ).closeEvent( event )
         except:
             pass
         
     def checkAE(self):
+        # Show cached installs right away and refresh them in the background
         self.adobeDir = self.adobePath.text().replace("\\","/")
-        self.aeExe = "Support Files/AfterFX.exe"
-        afterEffects = []
-        
-        if os.path.isdir(self.adobeDir):
-            afterEffects = [ae for ae in os.listdir(self.adobeDir) if 'After Effects' in ae and os.path.exists(os.path.join(self.adobeDir, ae, self.aeExe).replace('\\', '/'))]
-        
+        cache = getAECache()
+        if self.adobeDir in cache:
+            self.setAEVersions(cache[self.adobeDir])
+        
+        finder = AEFinder(self.adobeDir, self.aeExe, self)
+        finder.found.connect(self.aeFound)
+        finder.finished.connect(lambda: self.aeFinders.remove(finder))
+        self.aeFinders.append(finder)
+        finder.start()
+        
+    def aeFound(self, adobeDir, afterEffects):
+        cache = getAECache()
+        if cache.get(adobeDir) != afterEffects:
+            cache[adobeDir] = afterEffects
+            setAECache(cache)
+        if adobeDir == self.adobeDir:
+            self.setAEVersions(afterEffects)
+        
+    def setAEVersions(self, afterEffects):
         if afterEffects:
+            current = self.AEVersion.currentText()
             self.AEVersion.clear()
             self.AEVersion.addItems(afterEffects)
+            if current in afterEffects:
+                self.AEVersion.setCurrentIndex(afterEffects.index(current))
             
             self.missingAE.hide()
             self.AEVersion.show()
@@ -372,6 +733,11 @@ class MAYA2AE( QMainWindow ):
             self.AEVersion.hide()
             self.AELabel.hide()
             self.exportButton.setEnabled(False)
+            
+    def aeJobFinished(self, job):
+        pending = len(aeJobQueue.pending())
+        self.statusBar().showMessage("AE import %s %s (%s), %d pending" %(
+            os.path.basename(job.jsx), job.state, job.result, pending))
         
     def createLocator(self):
         if cmds.draggerContext(ctx, exists=True):
@@ -384,9 +750,7 @@ class MAYA2AE( QMainWindow ):
         self.bakeFrameEnd.setValue(int(cmds.playbackOptions(q=True, aet=True)))
         
     def refreshExportList(self):
-        self.exportList.clear()
-        baked = sorted(cmds.ls("::*.toAE", o=True))
-        self.exportList.addItems(baked)
+        self.exportListModel.reset()
         
     def selectFromList(self):
         cmds.select([item.text() for item in self.exportList.selectedItems()])
@@ -399,6 +763,7 @@ class MAYA2AE( QMainWindow ):
         useFullPath = self.bakeFullPath.isChecked()
         bakeRenderCamera = self.bakeCamera.isChecked()
         t,r,s = (self.bakeTranslate.isChecked(), self.bakeRotate.isChecked(), self.bakeScale.isChecked())
+        tolerances = getSimplifyTolerances(self.bakeTolerance.value()) if self.bakeSimplify.isChecked() else None
         
         toBake = cmds.ls(sl=1, l=1, transforms=1)
         if bakeRenderCamera:
@@ -412,7 +777,8 @@ class MAYA2AE( QMainWindow ):
                 baked = bakeCamLoc(
                     objects=toBake, fullpathname=useFullPath, 
                     startFrame=start, endFrame=end, 
-                    bakeTranslate=t, bakeRotate=r, bakeScale=s
+                    bakeTranslate=t, bakeRotate=r, bakeScale=s,
+                    tolerances=tolerances
                 )
                 for obj in baked:
                     # objShape = getShape(obj)
@@ -467,7 +833,25 @@ class MAYA2AE( QMainWindow ):
             try:
                 mayaExportPath = '/'.join([exportDir, compName + '.ma'])
                 jsxExportPath = '/'.join([exportDir, compName + '.jsx'])
-                if os.path.isdir( exportDir ):
+                if os.path.isdir( exportDir ) and self.exportDirect.isChecked():
+                    # Range the objects were baked with, the bake range fields may have changed since
+                    startFrame, endFrame = getBakedFrameRange(objectToExport) or (int(self.bakeFrameStart.text()), int(self.bakeFrameEnd.text()))
+                    writeKeyframeJSX( {
+                            'path': jsxExportPath, 
+                            'start': self.exportStartFrame.value(),
+                            'fps': self.exportFPS.value()
+                        }, 
+                        objectToExport,
+                        startFrame=startFrame,
+                        endFrame=endFrame,
+                        convertToMM=self.exportToMM.isChecked(), 
+                        resolution=(self.exportResolutionWidth.value(), self.exportResolutionHeight.value()), 
+                        deleteAfterImport=self.deleteAfterImport.isChecked()
+                    )
+                    if self.deleteBaked.isChecked():
+                        cmds.delete(objectToExport)
+                        self.refreshExportList()
+                elif os.path.isdir( exportDir ):
                     writeMA( mayaExportPath, objectToExport, 
                         convertToMM=self.exportToMM.isChecked(), 
                         convertResolution=(self.exportResolutionWidth.value(), self.exportResolutionHeight.value()), 
@@ -526,60 +910,123 @@ def calcDistance(p1, p2):
         (float(p2[2]) - float(p1[2]))**2
     )*0.5
 
-def get_object_visibility(object):
-    visible = cmds.getAttr("%s.visibility" %object)
-    
-    display_layer = cmds.listConnections(object , type="displayLayer")
-    visible = cmds.getAttr("%s.visibility" %display_layer[0]) if display_layer else visible
-    
-    if not visible:
+class VisibilityResolver(object):
+    # Memoize visibility per DAG path, ancestors are resolved once and shared by their children
+    # the memo is only valid for one operation, create a resolver per query and drop it after
+    def __init__(self):
+        self.cache = {}
+        
+    def clear(self):
+        self.cache = {}
+        
+    def isNodeVisible(self, dagPath):
+        # Display layers drive the node draw override, so this covers them too
+        fnDag = om.MFnDagNode(dagPath)
+        if not fnDag.findPlug('visibility', False).asBool():
+            return False
+        if fnDag.findPlug('overrideEnabled', False).asBool():
+            return fnDag.findPlug('overrideVisibility', False).asBool()
+        return True
+        
+    def isVisible(self, node):
+        dagPath = om.MDagPath(node) if isinstance(node, om.MDagPath) else getDagPath(node)
+        
+        # Walk up until an ancestor is already resolved
+        pending = []
+        visible = True
+        while dagPath.length() > 0:
+            path = dagPath.fullPathName()
+            if path in self.cache:
+                visible = self.cache[path]
+                break
+            pending.append((path, om.MDagPath(dagPath)))
+            dagPath.pop()
+        
+        for path, dagPath in reversed(pending):
+            visible = visible and self.isNodeVisible(dagPath)
+            self.cache[path] = visible
         return visible
-        
-    parents = cmds.listRelatives(object, p=True)
-    if parents:
-        visible = get_object_visibility(parents[0])
-        
-    return visible
-    
-ctx = 'myCtx'
-def createLocOnClick():
-    vpX, vpY, _ = cmds.draggerContext(ctx, query=True, anchorPoint=True)
-    # print ("Click:", vpX, vpY)
     
-    pos = om.MPoint()
-    dir = om.MVector()
-    hitpoint = om.MFloatPoint()
+    def getVisibility(self, nodes=[]):
+        return [self.isVisible(node) for node in nodes]
+        
+    def filterVisible(self, nodes=[]):
+        return [node for node in nodes if self.isVisible(node)]
+
+def get_object_visibility(object):
+    return VisibilityResolver().isVisible(object)
     
-    view = omui.M3dView.active3dView()
-    view.viewToWorld(int(vpX), int(vpY), pos, dir)
+def intersectBoundingBox(origin, direction, bbox):
+    # Slab test, returns the ray distance where it enters the box or None
+    bMin = bbox.min()
+    bMax = bbox.max()
+    tNear = -float('inf')
+    tFar = float('inf')
+    for o, d, lo, hi in [(origin.x, direction.x, bMin.x, bMax.x), (origin.y, direction.y, bMin.y, bMax.y), (origin.z, direction.z, bMin.z, bMax.z)]:
+        if abs(d) < 1e-12:
+            if o < lo or o > hi:
+                return None
+            continue
+        t1 = (lo - o) / d
+        t2 = (hi - o) / d
+        if t1 > t2:
+            t1, t2 = t2, t1
+        tNear = max(tNear, t1)
+        tFar = min(tFar, t2)
+        if tNear > tFar or tFar < 0:
+            return None
+    return max(tNear, 0.0)
+
+accelParams = None
+def getAccelParams():
+    # Reusing the same params lets maya keep the mesh acceleration grid between clicks
+    global accelParams
+    if accelParams is None:
+        accelParams = om.MFnMesh.autoUniformGridParams()
+    return accelParams
+
+def pickMesh(pos, dir):
+    resolver = VisibilityResolver()
+    origin = om.MPoint(pos)
+    direction = om.MVector(dir).normal()
     
-    cam = om.MDagPath()
-    view.getCamera(cam)
-    camPos = cmds.xform(getTransform(cam.fullPathName()), q=True, t=True, ws=True)
+    # Cull by world bounding box, then test the survivors nearest first
+    candidates = []
+    dagIt = om.MItDag(om.MItDag.kDepthFirst, om.MFn.kMesh)
+    while not dagIt.isDone():
+        dagPath = om.MDagPath()
+        dagIt.getPath(dagPath)
+        dagIt.next()
+        fnDag = om.MFnDagNode(dagPath)
+        if fnDag.isIntermediateObject():
+            continue
+        bbox = fnDag.boundingBox()
+        bbox.transformUsing(dagPath.inclusiveMatrix())
+        distance = intersectBoundingBox(origin, direction, bbox)
+        if distance is not None:
+            candidates.append((distance, dagPath))
+    candidates.sort(key=lambda c: c[0])
     
     nearest = None
     nearestDistance = None
-    
-    pos2 = om.MFloatPoint(pos.x, pos.y, pos.z)
-    for mesh in cmds.ls( type="mesh", ap=True ):
-        if not get_object_visibility(mesh):
+    hitpoint = om.MFloatPoint()
+    for boxDistance, dagPath in candidates:
+        if nearestDistance is not None and boxDistance > nearestDistance:
+            break
+        if not resolver.isVisible(dagPath):
             continue
         try:
-            selectionList = om.MSelectionList()
-            selectionList.add(mesh)
-            dagPath = om.MDagPath()
-            selectionList.getDagPath(0, dagPath)
             fnMesh = om.MFnMesh(dagPath)
             intersection = fnMesh.closestIntersection(
-                om.MFloatPoint(pos2),
-                om.MFloatVector(dir),
+                om.MFloatPoint(origin.x, origin.y, origin.z),
+                om.MFloatVector(direction),
                 None,
                 None,
                 False,
                 om.MSpace.kWorld,
                 99999,
                 False,
-                None,
+                getAccelParams(),
                 hitpoint,
                 None,
                 None,
@@ -588,36 +1035,354 @@ def createLocOnClick():
                 None
             )
         except:
-            print ("Error reading on", mesh)
+            print ("Error reading on", dagPath.fullPathName())
             continue
         if intersection:
-            x = hitpoint.x
-            y = hitpoint.y
-            z = hitpoint.z
-            
-            distance = calcDistance((x,y,z), camPos)
-            
-            if nearest is None:
-                nearest = (x,y,z)
+            distance = origin.distanceTo(om.MPoint(hitpoint.x, hitpoint.y, hitpoint.z))
+            if nearestDistance is None or nearestDistance > distance:
+                nearest = (hitpoint.x, hitpoint.y, hitpoint.z)
                 nearestDistance = distance
-            else:
-                if nearestDistance > distance :
-                    nearest = (x,y,z) 
-                    nearestDistance = distance
+    return nearest
+
+ctx = 'myCtx'
+def createLocOnClick():
+    vpX, vpY, _ = cmds.draggerContext(ctx, query=True, anchorPoint=True)
+    # print ("Click:", vpX, vpY)
+    
+    pos = om.MPoint()
+    dir = om.MVector()
+    
+    view = omui.M3dView.active3dView()
+    view.viewToWorld(int(vpX), int(vpY), pos, dir)
+    
+    nearest = pickMesh(pos, dir)
+    if nearest is None:
+        cmds.warning("No mesh under cursor")
+        return
     
     cmds.setAttr(cmds.spaceLocator()[0]+'.translate', nearest[0], nearest[1], nearest[2], type="double3")
     # print ("Position:", nearest)
-    # print ("Distance:", nearestDistance)
+
+aeJobQueue = AEJobQueue()
+def getAEMarkerPath(jsx):
+    return os.path.splitext(jsx)[0] + '.done'
+
+def formatJSXMarkerStart():
+    # Everything after this runs inside try, the marker tells AEJob how the import went
+    return """
+var importStatus = "ok";
+try {
+"""
+
+def formatJSXMarkerEnd():
+    return """
+} catch (err) {
+    importStatus = "error: " + err.toString();
+    app.endUndoGroup();
+}
+var marker = new File(filePath + "/" + compName + ".done");
+marker.open("w");
+marker.write(importStatus);
+marker.close();
+"""
 
 def spawnAE(aePath, jsx):
-    subprocess.Popen([aePath, '-r', jsx])
+    return aeJobQueue.add(aePath, jsx)
+
+def getAECache():
+    # Discovered installs per adobe directory, persisted between sessions
+    if cmds.optionVar(exists='MAYA2AE_AfterEffects'):
+        try:
+            return json.loads(cmds.optionVar(q='MAYA2AE_AfterEffects'))
+        except ValueError:
+            pass
+    return {}
+
+def setAECache(cache):
+    cmds.optionVar(sv=('MAYA2AE_AfterEffects', json.dumps(cache)))
     
 def getRenderCam():
     renderCams = [getTransform(c) for c in cmds.ls(l=True, ca=True) if cmds.getAttr('%s.renderable' %c)]
     return renderCams
 
-def bakeCamLoc(objects=[], fullpathname=True, startFrame=1, endFrame=1, bakeTranslate=True, bakeRotate=True, bakeScale=True):
+def getDagPath(node):
+    selectionList = om.MSelectionList()
+    selectionList.add(node)
+    dagPath = om.MDagPath()
+    selectionList.getDagPath(0, dagPath)
+    return dagPath
+
+def getDependNode(node):
+    selectionList = om.MSelectionList()
+    selectionList.add(node)
+    mObject = om.MObject()
+    selectionList.getDependNode(0, mObject)
+    return mObject
+
+def sampleWorldMatrices(objects=[], frames=[]):
+    # Evaluate every worldMatrix in a time context, the timeline is never scrubbed
+    plugs = []
+    for obj in objects:
+        dagPath = getDagPath(obj)
+        plug = om.MFnDagNode(dagPath).findPlug('worldMatrix', False)
+        plugs.append(plug.elementByLogicalIndex(dagPath.instanceNumber()))
+    
+    samples = [[] for obj in objects]
+    for i in frames:
+        context = om.MDGContext(om.MTime(i, om.MTime.uiUnit()))
+        for plug, matrices in zip(plugs, samples):
+            matrixData = om.MFnMatrixData(plug.asMObject(context))
+            matrices.append(om.MMatrix(matrixData.matrix()))
+    return samples
+
+def decomposeMatrices(matrices, attrs=[]):
+    # Split matrices into per channel arrays, in internal units (cm / radians)
+    channels = dict((attr, []) for attr in attrs)
+    previous = None
+    for matrix in matrices:
+        transform = om.MTransformationMatrix(matrix)
+        translate = transform.getTranslation(om.MSpace.kWorld)
+        rotate = transform.eulerRotation()
+        rotate.reorderIt(om.MEulerRotation.kXYZ)
+        if previous is not None:
+            # Keep euler continuity between frames
+            rotate.setToClosestSolution(previous)
+        previous = rotate
+        scale = [om.MVector(matrix(row, 0), matrix(row, 1), matrix(row, 2)).length() for row in range(3)]
+        
+        values = {
+            'tx': translate.x, 'ty': translate.y, 'tz': translate.z,
+            'rx': rotate.x, 'ry': rotate.y, 'rz': rotate.z,
+            'sx': scale[0], 'sy': scale[1], 'sz': scale[2],
+        }
+        for attr in attrs:
+            channels[attr].append(values[attr])
+    return channels
+
+def getAnimCurveType(attrType):
+    if attrType == 'doubleLinear':
+        return 'animCurveTL'
+    if attrType == 'doubleAngle':
+        return 'animCurveTA'
+    return 'animCurveTU'
+
+def writeAnimCurve(plugName, frames=[], values=[], linear=False):
+    # Curve node is created with cmds so undo removes it, keys are written in one call
+    attrType = cmds.getAttr(plugName, type=True)
+    curveName = plugName.split('|')[-1].replace('.', '_')
+    curve = cmds.createNode(getAnimCurveType(attrType), n=curveName, ss=True)
+    cmds.connectAttr(curve+'.output', plugName, f=True)
+    
+    times = om.MTimeArray()
+    keyValues = om.MDoubleArray()
+    for i, value in zip(frames, values):
+        times.append(om.MTime(i, om.MTime.uiUnit()))
+        keyValues.append(value)
+    fnCurve = om.MFnAnimCurve(getDependNode(curve))
+    if attrType in ['bool', 'enum', 'long', 'short', 'byte']:
+        fnCurve.addKeys(times, keyValues, om.MFnAnimCurve.kTangentStep, om.MFnAnimCurve.kTangentStep)
+    elif linear:
+        # Simplified keys rely on linear interpolation to stay within tolerance
+        fnCurve.addKeys(times, keyValues, om.MFnAnimCurve.kTangentLinear, om.MFnAnimCurve.kTangentLinear)
+    else:
+        fnCurve.addKeys(times, keyValues)
+    return curve
+
+# Simplify tolerance of each channel type, in the unit shown next to it
+# the ui value scales all of them, keys are simplified once when baking
+SIMPLIFY_TOLERANCES = {'linear': 0.01, 'angle': 0.01, 'scale': 0.0001, 'focal': 0.01, 'other': 0.001}
+SIMPLIFY_UNITS = {'linear': 'cm', 'angle': 'deg', 'scale': '', 'focal': 'mm', 'other': ''}
+
+def getSimplifyTolerances(scale=1.0):
+    return dict((kind, tolerance*scale) for kind, tolerance in SIMPLIFY_TOLERANCES.items())
+
+def getChannelType(plugName):
+    attr = plugName.split('.')[-1]
+    attrType = cmds.getAttr(plugName, type=True)
+    if attrType == 'doubleAngle':
+        return 'angle'
+    if attrType == 'doubleLinear':
+        return 'linear'
+    if attr in ['sx', 'sy', 'sz', 'scaleX', 'scaleY', 'scaleZ']:
+        return 'scale'
+    if attr in ['fl', 'focalLength']:
+        return 'focal'
+    return 'other'
+
+class KeyReport(object):
+    # Accumulate how many keys simplification removed and the error it introduced per channel type
+    def __init__(self):
+        self.total = 0
+        self.kept = 0
+        self.maxErrors = {}
+        
+    def add(self, total, kept, error, kind='other'):
+        self.total += total
+        self.kept += kept
+        self.maxErrors[kind] = max(self.maxErrors.get(kind, 0.0), error)
+        
+    def show(self, name):
+        errors = ', '.join('%s %g%s' %(k, v, SIMPLIFY_UNITS.get(k, '')) for k, v in sorted(self.maxErrors.items()))
+        print ("%s : removed %d of %d keys, max error %s" %(name, self.total-self.kept, self.total, errors))
+
+def simplifyKeys(frames=[], values=[], tolerance=0.001):
+    # Ramer-Douglas-Peucker on the value axis, values can be scalars or vectors
+    # static channels collapse to one key and linear runs to their two end keys
+    frames = list(frames)
+    values = list(values)
+    count = len(frames)
+    if count < 3:
+        return frames, values, 0.0
+    
+    if np is not None:
+        times = np.asarray(frames, dtype=np.float64)
+        data = np.asarray(values, dtype=np.float64).reshape(count, -1)
+        staticError = float(np.abs(data - data[0]).max())
+        if staticError <= tolerance:
+            return frames[:1], values[:1], staticError
+        
+        keep = np.zeros(count, dtype=bool)
+        keep[0] = keep[-1] = True
+        maxError = 0.0
+        segments = [(0, count-1)]
+        while segments:
+            first, last = segments.pop()
+            if last - first < 2:
+                continue
+            weight = ((times[first+1:last] - times[first]) / (times[last] - times[first]))[:, None]
+            line = data[first] + weight * (data[last] - data[first])
+            error = np.abs(data[first+1:last] - line).max(axis=1)
+            index = int(error.argmax())
+            if error[index] > tolerance:
+                split = first + 1 + index
+                keep[split] = True
+                segments += [(first, split), (split, last)]
+            else:
+                maxError = max(maxError, float(error[index]))
+        indices = np.nonzero(keep)[0].tolist()
+    else:
+        data = [list(v) if isinstance(v, (list, tuple)) else [v] for v in values]
+        staticError = max(abs(a - b) for row in data for a, b in zip(row, data[0]))
+        if staticError <= tolerance:
+            return frames[:1], values[:1], staticError
+        
+        keep = [False] * count
+        keep[0] = keep[-1] = True
+        maxError = 0.0
+        segments = [(0, count-1)]
+        while segments:
+            first, last = segments.pop()
+            if last - first < 2:
+                continue
+            span = float(frames[last] - frames[first])
+            split, splitError = None, -1.0
+            for i in range(first+1, last):
+                weight = (frames[i] - frames[first]) / span
+                error = max(
+                    abs(v - (a + weight * (b - a))) 
+                    for v, a, b in zip(data[i], data[first], data[last])
+                )
+                if error > splitError:
+                    split, splitError = i, error
+            if splitError > tolerance:
+                keep[split] = True
+                segments += [(first, split), (split, last)]
+            else:
+                maxError = max(maxError, splitError)
+        indices = [i for i in range(count) if keep[i]]
+    
+    return [frames[i] for i in indices], [values[i] for i in indices], maxError
+
+def isTimeVarying(plugName):
+    # Keyed, expression or any other input connection, also on the parent compound
+    plug = om.MPlug()
+    selectionList = om.MSelectionList()
+    selectionList.add(plugName)
+    selectionList.getPlug(0, plug)
+    if plug.isDestination():
+        return True
+    if plug.isChild() and plug.parent().isDestination():
+        return True
+    return False
+
+def classifyCameraAttributes(origShape, bakedShape):
+    staticAttrs = []
+    animatedAttrs = []
+    for attr in sorted(cmds.listAttr(bakedShape, keyable=True) or []):
+        try:
+            attrType = cmds.getAttr( '%s.%s' %(origShape,attr), type=True )
+            if attrType in [None, 'string', 'TdataCompound', 'matrix', 'double2', 'double3', 'message', 'float3']:
+                continue
+            if isTimeVarying('%s.%s' %(origShape,attr)):
+                animatedAttrs.append(attr)
+            else:
+                staticAttrs.append(attr)
+        except:
+            cmds.warning('Fail on %s.%s' %(bakedShape,attr))
+    return staticAttrs, animatedAttrs
+
+def sampleAttributes(node, attrs=[], frames=[]):
+    # Evaluate every plug in a time context, values are in internal units
+    plugs = []
+    for attr in attrs:
+        plug = om.MPlug()
+        selectionList = om.MSelectionList()
+        selectionList.add('%s.%s' %(node,attr))
+        selectionList.getPlug(0, plug)
+        plugs.append(plug)
+    
+    samples = [[] for attr in attrs]
+    for i in frames:
+        context = om.MDGContext(om.MTime(i, om.MTime.uiUnit()))
+        for plug, values in zip(plugs, samples):
+            values.append(plug.asDouble(context))
+    return dict(zip(attrs, samples))
+
+def writeSimplifiedAnimCurve(plugName, frames=[], values=[], tolerances=None, report=None):
+    if tolerances is None:
+        return writeAnimCurve(plugName, frames, values)
+    kind = getChannelType(plugName)
+    # Angles are sampled in radians, their tolerance is in degrees
+    unit = math.degrees(1) if kind == 'angle' else 1.0
+    keyFrames, keyValues, error = simplifyKeys(frames, values, tolerances[kind] / unit)
+    if report is not None:
+        report.add(len(frames), len(keyFrames), error * unit, kind)
+    return writeAnimCurve(plugName, keyFrames, keyValues, linear=True)
+
+def getKeyFrames(node, attrs=[], frames=[]):
+    # Frames keyed on any of the channels, every frame when one is driven by something other than a curve
+    frames = list(frames)
+    keyed = set()
+    for attr in attrs:
+        plugName = '%s.%s' %(node, attr)
+        curves = cmds.listConnections(plugName, s=True, d=False, type='animCurve')
+        if curves:
+            keyed.update(cmds.keyframe(curves[0], q=True, tc=True) or [])
+        elif isTimeVarying(plugName):
+            return frames
+    return [i for i in frames if i in keyed]
+
+def copyStaticAttributes(origShape, bakedShape, attrs=[]):
+    for attr in attrs:
+        try:
+            cmds.setAttr( '%s.%s' %(bakedShape,attr), cmds.getAttr( '%s.%s' %(origShape,attr) ) )
+        except:
+            cmds.warning('Fail on %s.%s' %(bakedShape,attr))
+
+def bakeCameraAttributes(origShape, bakedShape, frames=[], tolerances=None, report=None):
+    staticAttrs, animatedAttrs = classifyCameraAttributes(origShape, bakedShape)
+    copyStaticAttributes(origShape, bakedShape, staticAttrs)
+    
+    samples = sampleAttributes(origShape, animatedAttrs, frames)
+    for attr in animatedAttrs:
+        writeSimplifiedAnimCurve('%s.%s' %(bakedShape,attr), frames, samples[attr], tolerances, report)
+    
+    return staticAttrs, animatedAttrs
+
+def bakeCamLoc(objects=[], fullpathname=True, startFrame=1, endFrame=1, bakeTranslate=True, bakeRotate=True, bakeScale=True, tolerances=None):
+    # tolerances from getSimplifyTolerances, None keys every frame
     frames = range(startFrame, endFrame+1)
+    report = KeyReport()
     bakeTransform = []
     if bakeTranslate:
         bakeTransform += ['tx', 'ty', 'tz']
@@ -626,19 +1391,11 @@ def bakeCamLoc(objects=[], fullpathname=True, startFrame=1, endFrame=1, bakeTran
     if bakeScale:
         bakeTransform += ['sx', 'sy', 'sz']
     
-    transformsToBake = []
-    dummies = []
+    bakedObjects = []
     for obj in objects:
         origShape = getShape(obj)
         objName = obj.replace('|','_')[1:] if fullpathname else obj.split('|')[-1]
         
-        # Create locator to get translate, rotate and scale
-        dummyName = '%s_Temp' %objName
-        if cmds.objExists(dummyName):
-            cmds.delete(dummyName)
-        dummy = cmds.spaceLocator(n=dummyName)[0]
-        cmds.parentConstraint(obj, dummy) # Constraint dummy to original object
-        
         isCamera = cmds.nodeType(getShape(obj)) == 'camera'
         bakedName = 'Cam_%s_Baked' %objName if isCamera else 'Null_%s_Baked' %objName
         
@@ -649,62 +1406,66 @@ def bakeCamLoc(objects=[], fullpathname=True, startFrame=1, endFrame=1, bakeTran
         if isCamera:
             # Create Camera
             baked = cmds.rename(cmds.camera()[0], bakedName)
-            # Copy all atributes
-            bakedShape = getShape(baked)
-            attrs = cmds.listAttr(bakedShape)
-            fail = []
-            for attr in sorted(attrs):
-                try:
-                    attrType = cmds.getAttr( '%s.%s' %(origShape,attr), type=True )
-                    if attrType not in [None, 'string', 'TdataCompound', 'matrix', 'double2', 'double3', 'message', 'float3']:
-                        # if cmds.getAttr('%s.%s' %(bakedShape,attr), settable=True):
-                        if cmds.getAttr('%s.%s' %(bakedShape,attr), keyable=True):
-                            for i in frames:
-                                value = cmds.getAttr( '%s.%s' %(origShape,attr), time=i )
-                                cmds.setKeyframe( '%s.%s' %(bakedShape,attr),  t=i, v=value )
-                except:
-                    cmds.warning('Fail on %s.%s' %(bakedShape,attr))
+            # Copy all atributes, only time varying attributes are keyed
+            bakeCameraAttributes(origShape, getShape(baked), frames, tolerances, report)
         else:
             # Create locator and copy translate, rotate and scale
             baked = cmds.spaceLocator(n=bakedName)[0]
-        transformsToBake.append((dummy, baked))
+        bakedObjects.append(baked)
         
     # Copy translate, rotate and scale
-    for i in frames:
-        cmds.currentTime(i)
-        for dummy, baked in transformsToBake:
+    if bakeTransform:
+        samples = sampleWorldMatrices(objects, frames)
+        for baked, matrices in zip(bakedObjects, samples):
+            channels = decomposeMatrices(matrices, bakeTransform)
             for attr in bakeTransform:
-                value = cmds.getAttr('%s.%s' %(dummy,attr))
-                cmds.setKeyframe( '%s.%s' %(baked,attr),  t=i, v=value )
+                writeSimplifiedAnimCurve('%s.%s' %(baked,attr), frames, channels[attr], tolerances, report)
     
-    # Delete dummy after copying all translate, rotate and scale
-    dummies = [dummy for dummy, baked in transformsToBake]
-    bakedObjects = [baked for dummy, baked in transformsToBake]
+    if tolerances is not None:
+        report.show("bakeCamLoc")
     cmds.select(objects, r=True)
-    cmds.delete(dummies)
     
     return bakedObjects
     
+def clearAnimCurve(plugName):
+    curves = cmds.listConnections(plugName, s=True, d=False, type='animCurve')
+    if curves:
+        cmds.delete(curves)
+
+def convertAEFocalLength(hApt, focalLength, defApt=(36, 24)):
+    # Focal length matching the horizontal FOV on a 36x24mm aperture
+    # FOV = 2*atan(hApt/(2*focal)), aeFocal = (defApt/2)/tan(FOV/2) = defApt*focal/hApt
+    if np is not None:
+        hApt = np.asarray(hApt, dtype=np.float64) *25.4
+        focalLength = np.asarray(focalLength, dtype=np.float64)
+        return (defApt[0] * focalLength / hApt).tolist()
+    return [defApt[0] * f / (h *25.4) for h, f in zip(hApt, focalLength)]
+
 def fixAEFocalLength(cam, startFrame=1, endFrame=1):
     if cmds.nodeType(getShape(cam)) == 'camera':
-        camShape = cmds.listRelatives(cam, s=True)[0]
-        
-        for i in range(startFrame, endFrame+1):
-            hApt = cmds.getAttr( '%s.horizontalFilmAperture' %camShape, time=i ) *25.4
-            vApt = cmds.getAttr( '%s.verticalFilmAperture' %camShape, time=i ) *25.4
-            focalLength = cmds.getAttr( '%s.focalLength' %camShape, time=i )
-            #diag = (hApt**2 + vApt**2)**.5
-            diag = hApt
-            FOV = 2 * math.degrees(math.atan( hApt/ (2*focalLength)))
-            
-            # make sure AE camera aperture is 36x24mm 
-            # then adjust camera focal length
-            defApt = (36, 24)
-            ae_focalLength = (defApt[0]/2)/math.tan(math.radians(FOV/2))
-            
-            cmds.setKeyframe( '%s.horizontalFilmAperture' %camShape,  t=i, v=defApt[0]/25.4 ) 
-            cmds.setKeyframe( '%s.verticalFilmAperture' %camShape,  t=i, v=defApt[1]/25.4 )
-            cmds.setKeyframe( camShape, attribute='focalLength', t=i, v=ae_focalLength )
+        camShape = getShape(cam)
+        frames = range(startFrame, endFrame+1)
+        attrs = ['horizontalFilmAperture', 'focalLength']
+        
+        # Converted on the existing keys, keys simplified at bake are not simplified again
+        # the conversion is linear in focal length so the error stays within the bake tolerance
+        keyFrames = getKeyFrames(camShape, attrs, frames) or list(frames[:1])
+        samples = sampleAttributes(camShape, attrs, keyFrames)
+        ae_focalLength = convertAEFocalLength(samples['horizontalFilmAperture'], samples['focalLength'])
+        
+        # make sure AE camera aperture is 36x24mm 
+        # the aperture is constant so it is never keyed
+        defApt = (36, 24)
+        for attr, value in [('horizontalFilmAperture', defApt[0]/25.4), ('verticalFilmAperture', defApt[1]/25.4)]:
+            clearAnimCurve('%s.%s' %(camShape, attr))
+            cmds.setAttr('%s.%s' %(camShape, attr), value)
+        
+        # then adjust camera focal length
+        clearAnimCurve('%s.focalLength' %camShape)
+        if max(ae_focalLength) - min(ae_focalLength) > 1e-6:
+            writeAnimCurve('%s.focalLength' %camShape, keyFrames, ae_focalLength, linear=len(keyFrames) < len(frames))
+        else:
+            cmds.setAttr('%s.focalLength' %camShape, ae_focalLength[0])
     
 def writeMA(filepath, objects=[], convertToMM=True, convertResolution=(), deleteUnknown=False):
     # backup
@@ -739,6 +1500,149 @@ def writeMA(filepath, objects=[], convertToMM=True, convertResolution=(), delete
         cmds.setAttr('defaultResolution.height', camHeight)
         cmds.setAttr('defaultResolution.deviceAspectRatio', (camWidth/float(camHeight)))
     
+def formatJSXArray(values):
+    return '[%s]' %', '.join(formatJSXArray(v) if isinstance(v, (list, tuple)) else '%.10g' %v for v in values)
+
+def getAELayerName(obj):
+    layerName = obj.split('|')[-1]
+    if layerName.endswith('_Baked'):
+        layerName = layerName[:-len('_Baked')]
+    if layerName.startswith('Null_'):
+        layerName = layerName[len('Null_'):]
+    return layerName
+
+def sampleAEValues(obj, frames=[], scale=1.0, resolution=(1920, 1080)):
+    # Convert baked maya channels to AE space, AE is y down and z into the screen
+    width, height = resolution
+    channels = sampleAttributes(obj, ['tx', 'ty', 'tz', 'rx', 'ry', 'rz', 'sx', 'sy', 'sz'], frames)
+    
+    values = [
+        ('transform.xPosition', [x*scale + width/2.0 for x in channels['tx']]),
+        ('transform.yPosition', [-y*scale + height/2.0 for y in channels['ty']]),
+        ('transform.zPosition', [-z*scale for z in channels['tz']]),
+        ('transform.xRotation', [math.degrees(r) for r in channels['rx']]),
+        ('transform.yRotation', [-math.degrees(r) for r in channels['ry']]),
+        ('transform.zRotation', [-math.degrees(r) for r in channels['rz']]),
+    ]
+    
+    shape = getShape(obj)
+    if cmds.nodeType(shape) == 'camera':
+        camera = sampleAttributes(shape, ['focalLength', 'horizontalFilmAperture'], frames)
+        zoom = [
+            f * width / (hApt*25.4) 
+            for f, hApt in zip(camera['focalLength'], camera['horizontalFilmAperture'])
+        ]
+        values.append(('cameraOption.zoom', zoom))
+    else:
+        values.append(('transform.scale', [
+            [x*100, y*100, z*100] 
+            for x, y, z in zip(channels['sx'], channels['sy'], channels['sz'])
+        ]))
+    return values
+
+def getBakedFrameRange(objects=[]):
+    # First and last key on the objects and their shapes, None when nothing is keyed
+    nodes = list(objects) + [shape for shape in map(getShape, objects) if shape]
+    times = cmds.keyframe(nodes, q=True, tc=True) or []
+    if not times:
+        return None
+    return int(math.floor(min(times))), int(math.ceil(max(times)))
+
+def getAEKeyFrames(obj, frames=[]):
+    # Frames to key for every AE property, the baked key frames of the maya channels it comes from
+    # AE conversions are linear per channel, so linear baked keys keep their error once exported
+    shape = getShape(obj)
+    sources = [
+        ('transform.xPosition', obj, ['tx']),
+        ('transform.yPosition', obj, ['ty']),
+        ('transform.zPosition', obj, ['tz']),
+        ('transform.xRotation', obj, ['rx']),
+        ('transform.yRotation', obj, ['ry']),
+        ('transform.zRotation', obj, ['rz']),
+    ]
+    if cmds.nodeType(shape) == 'camera':
+        sources.append(('cameraOption.zoom', shape, ['focalLength', 'horizontalFilmAperture']))
+    else:
+        sources.append(('transform.scale', obj, ['sx', 'sy', 'sz']))
+    return dict((prop, getKeyFrames(node, attrs, frames) or list(frames[:1])) for prop, node, attrs in sources)
+
+def writeKeyframeJSX( data, objects=[], startFrame=1, endFrame=1, convertToMM=True, resolution=(1920, 1080), deleteAfterImport=False, chunkSize=250 ):
+    # Write baked channels straight into the JSX, frames are sampled and written chunk by chunk
+    # only frames keyed on the baked channels are written, simplified bakes stay simplified
+    compname = os.path.splitext(os.path.basename(data['path']))[0]
+    dir = os.path.dirname(data['path'])
+    frames = range(startFrame, endFrame+1)
+    scale = 10.0 if convertToMM else 1.0
+    fps = float(data['fps'])
+    
+    with open(data['path'], "w") as jsxFile:
+        jsxFile.write("""
+var compName = "{compName}"
+var filePath = "{jsxPath}"
+var startFrame = {start}
+var fps = {fps}
+{markerStart}
+app.beginUndoGroup("Maya2AE");
+
+var aeVersion = app.version;
+aeVersion = parseFloat(aeVersion.substring(0, aeVersion.indexOf("x")));
+
+//RENAME OLD
+for(var index=1; index<=app.project.numItems; index++) {{ 
+    var oldComp = app.project.item(index);
+    if (oldComp.name == compName)
+        {{oldComp.name = oldComp.name + "_old_DELETE"; }}
+}}
+//CREATE COMP
+var comp = app.project.items.addComp(compName, {width}, {height}, 1.0, {duration}, fps);
+if (aeVersion >= 17.1) {{
+    comp.displayStartFrame = startFrame;
+}} else {{
+    comp.displayStartTime = startFrame/fps + 0.00001;
+}}
+""".format(compName=compname, jsxPath=dir, start=data['start'], fps=fps, 
+            width=resolution[0], height=resolution[1], duration=len(frames)/fps, markerStart=formatJSXMarkerStart()))
+        
+        layers = []
+        for index, obj in enumerate(objects):
+            layer = 'layer%d' %index
+            if cmds.nodeType(getShape(obj)) == 'camera':
+                jsxFile.write('var %s = comp.layers.addCamera("%s", [%d, %d]);\n' %(
+                    layer, getAELayerName(obj), resolution[0]/2, resolution[1]/2))
+                jsxFile.write('%s.autoOrient = AutoOrientType.NO_AUTO_ORIENT;\n' %layer)
+            else:
+                jsxFile.write('var %s = comp.layers.addNull();\n' %layer)
+                jsxFile.write('%s.name = "%s";\n' %(layer, getAELayerName(obj)))
+                jsxFile.write('%s.threeDLayer = true;\n' %layer)
+            # Separated dimensions avoid spatial interpolation between simplified keys
+            jsxFile.write('%s.transform.position.dimensionsSeparated = true;\n' %layer)
+            layers.append((layer, obj, getAEKeyFrames(obj, frames)))
+        
+        #KEYFRAMES
+        for chunkStart in range(0, len(frames), chunkSize):
+            chunk = frames[chunkStart:chunkStart+chunkSize]
+            jsxFile.write('var times = %s;\n' %formatJSXArray([(i-startFrame)/fps for i in chunk]))
+            for layer, obj, keyFrames in layers:
+                for prop, values in sampleAEValues(obj, chunk, scale, resolution):
+                    propFrames = [i for i in keyFrames[prop] if chunk[0] <= i <= chunk[-1]]
+                    if len(propFrames) == len(chunk):
+                        jsxFile.write('%s.%s.setValuesAtTimes(times, %s);\n' %(layer, prop, formatJSXArray(values)))
+                    elif propFrames:
+                        jsxFile.write('%s.%s.setValuesAtTimes(%s, %s);\n' %(
+                            layer, prop, formatJSXArray([(i-startFrame)/fps for i in propFrames]), 
+                            formatJSXArray([values[i-chunk[0]] for i in propFrames])))
+        
+        jsxFile.write("""
+comp.openInViewer();
+app.endUndoGroup();
+""")
+        jsxFile.write(formatJSXMarkerEnd())
+        if deleteAfterImport:
+            jsxFile.write("""
+var jsx = new File(filePath + "/" + compName +".jsx")
+jsx.remove()
+""")
+
 def writeJSX( data, deleteAfterImport=False ):
     compname = os.path.splitext(os.path.basename(data['path']))[0]
     dir = os.path.dirname(data['path'])
@@ -749,6 +1653,7 @@ var filePath = "{maPath}"
 var startFrame = "{start}"
 var fps = "{fps}"
 """.format(compName=compname, maPath=dir, start=data['start'], fps=data['fps'])
+    jsxCmd += formatJSXMarkerStart()
     jsxCmd +="""
 app.beginUndoGroup("Maya2AE");
 
@@ -794,6 +1699,7 @@ for (var index=1; index <=app.project.numItems; index++) {
 
 app.endUndoGroup();
 """
+    jsxCmd += formatJSXMarkerEnd()
     if deleteAfterImport:
         jsxCmd += """
 var ma = new File(filePath + "/" + compName +".ma")
@@ -807,5 +1713,75 @@ jsx.remove()
     with open(data['path'], "w") as jsxFile:
         jsxFile.write(jsxCmd)
 
+#### BENCHMARK ####
+# Camera shape attributes animated on the benchmark camera, in this order
+BENCHMARK_CAMERA_ATTRS = [
+    'focalLength', 'horizontalFilmAperture', 'verticalFilmAperture', 'horizontalFilmOffset',
+    'verticalFilmOffset', 'focusDistance', 'fStop', 'shutterAngle',
+    'centerOfInterest', 'lensSqueezeRatio', 'overscan', 'cameraScale',
+]
+
+def createBenchmarkCamera(name, attrs=[], startFrame=1, endFrame=1):
+    # Camera with two keys on each attr, named uniquely so nothing in the scene is touched
+    cam = cmds.rename(cmds.camera()[0], name+'#')
+    shape = getShape(cam)
+    for attr in attrs:
+        value = cmds.getAttr('%s.%s' %(shape, attr))
+        cmds.setKeyframe(shape, at=attr, t=startFrame, v=value)
+        cmds.setKeyframe(shape, at=attr, t=endFrame, v=value*1.5 + 1)
+    return cam
+
+def deleteBenchmarkCamera(cam):
+    if not cmds.objExists(cam):
+        return
+    curves = cmds.listConnections(getShape(cam), s=True, d=False, type='animCurve') or []
+    cmds.delete([cam] + curves)
+
+def benchmarkCameraBake(frameCounts=(10, 100, 1000), animatedCounts=(1, 4, 12)):
+    # Time each stage of the camera attribute bake on temporary cameras
+    # Evals is the number of plug evaluations in a time context, Keys the keys written with addKeys
+    startFrame = int(cmds.playbackOptions(q=True, min=True))
+    results = []
+    for animatedCount in animatedCounts:
+        for frameCount in frameCounts:
+            endFrame = startFrame+frameCount-1
+            frames = range(startFrame, endFrame+1)
+            source = createBenchmarkCamera('benchmarkSourceCam', BENCHMARK_CAMERA_ATTRS[:animatedCount], startFrame, endFrame)
+            baked = cmds.rename(cmds.camera()[0], 'benchmarkBakedCam#')
+            try:
+                origShape = getShape(source)
+                bakedShape = getShape(baked)
+                
+                startTime = time.time()
+                staticAttrs, animatedAttrs = classifyCameraAttributes(origShape, bakedShape)
+                classifyTime = time.time() - startTime
+                
+                startTime = time.time()
+                copyStaticAttributes(origShape, bakedShape, staticAttrs)
+                copyTime = time.time() - startTime
+                
+                startTime = time.time()
+                samples = sampleAttributes(origShape, animatedAttrs, frames)
+                sampleTime = time.time() - startTime
+                
+                startTime = time.time()
+                curves = [writeAnimCurve('%s.%s' %(bakedShape,attr), frames, samples[attr]) for attr in animatedAttrs]
+                writeTime = time.time() - startTime
+                
+                keys = sum(cmds.keyframe(curve, q=True, kc=True) for curve in curves)
+                results.append((
+                    frameCount, len(staticAttrs), len(animatedAttrs), len(animatedAttrs)*len(frames), keys,
+                    classifyTime, copyTime, sampleTime, writeTime
+                ))
+            finally:
+                deleteBenchmarkCamera(baked)
+                deleteBenchmarkCamera(source)
+    
+    print ("%8s %8s %8s %8s %8s %10s %10s %10s %10s" %("Frames", "Static", "Animated", "Evals", "Keys", "Classify", "Copy", "Sample", "Write"))
+    for result in results:
+        print ("%8d %8d %8d %8d %8d %10.3f %10.3f %10.3f %10.3f" %result)
+    return results
+
 #### RUN ####
-MAYA2AE(parent=getMayaWindow())
+if __name__ == '__main__':
+    MAYA2AE(parent=getMayaWindow())
@@ -8,13 +8,278 @@ Usage:
 3. Bake
 '''
 
-from maya import mel
+from maya import cmds, mel
+import maya.OpenMaya as om
 import pymel.core as pm
 
-from PySide2.QtWidgets import QApplication, QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QSpinBox, QProgressBar
+from PySide2.QtWidgets import QApplication, QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QSpinBox, QProgressBar, QCheckBox, QLineEdit
 from PySide2.QtCore import Qt
 
+import os
+import math
+import time
+import json
+import uuid
+import struct
+import itertools
 import traceback
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+### Instance Math
+# Matrices use maya row vector convention, rotate order 'xyz' is Rx * Ry * Rz
+
+def parseRotateOrders(enumString):
+    # attributeQuery listEnum string, 'XYZ:XZY' or 'XYZ=0:XZY=1', to {value: 'xyz'}
+    orders = {}
+    value = 0
+    for field in enumString.split(':'):
+        name, sep, index = field.partition('=')
+        if sep:
+            value = int(index)
+        order = name.strip().lower()
+        if sorted(order) == ['x', 'y', 'z']:
+            orders[value] = order
+        value += 1
+    return orders
+
+def axisMatrix(angle, axis):
+    c, s = math.cos(angle), math.sin(angle)
+    if axis == 'x':
+        return [[1,0,0], [0,c,s], [0,-s,c]]
+    if axis == 'y':
+        return [[c,0,-s], [0,1,0], [s,0,c]]
+    return [[c,s,0], [-s,c,0], [0,0,1]]
+
+def axisMatrices(angles, axis):
+    c, s = np.cos(angles), np.sin(angles)
+    m = np.zeros((len(angles), 3, 3))
+    i, j = {'x': (1, 2), 'y': (2, 0), 'z': (0, 1)}[axis]
+    k = 3 - i - j
+    m[:, k, k] = 1
+    m[:, i, i] = c
+    m[:, j, j] = c
+    m[:, i, j] = s
+    m[:, j, i] = -s
+    return m
+
+def multMatrix3(a, b):
+    return [[sum(a[r][k] * b[k][c] for k in range(3)) for c in range(3)] for r in range(3)]
+
+def cross(a, b):
+    return (a[1]*b[2] - a[2]*b[1], a[2]*b[0] - a[0]*b[2], a[0]*b[1] - a[1]*b[0])
+
+def normalize(v):
+    length = math.sqrt(v[0]*v[0] + v[1]*v[1] + v[2]*v[2])
+    if length < 1e-12:
+        return (0.0, 0.0, 0.0)
+    return (v[0]/length, v[1]/length, v[2]/length)
+
+def eulerToMatrices(rotations, order='xyz'):
+    # Rotations in radians, one row per particle
+    if np is not None:
+        angles = np.asarray(rotations, dtype=np.float64).reshape(-1, 3)
+        result = np.tile(np.eye(3), (len(angles), 1, 1))
+        for axis in order:
+            result = np.einsum('nij,njk->nik', result, axisMatrices(angles[:, 'xyz'.index(axis)], axis))
+        return result
+    
+    result = []
+    for rotation in rotations:
+        m = [[1,0,0], [0,1,0], [0,0,1]]
+        for axis in order:
+            m = multMatrix3(m, axisMatrix(rotation['xyz'.index(axis)], axis))
+        result.append(m)
+    return result
+
+def matricesToEuler(matrices):
+    # Decompose to 'xyz' rotate order in degrees
+    if np is not None:
+        m = np.asarray(matrices, dtype=np.float64).reshape(-1, 3, 3)
+        sy = np.clip(-m[:, 0, 2], -1.0, 1.0)
+        rx = np.arctan2(m[:, 1, 2], m[:, 2, 2])
+        ry = np.arcsin(sy)
+        rz = np.arctan2(m[:, 0, 1], m[:, 0, 0])
+        gimbal = np.abs(sy) > 0.999999
+        rx[gimbal] = np.arctan2(-m[gimbal, 2, 1], m[gimbal, 1, 1])
+        rz[gimbal] = 0.0
+        return np.degrees(np.stack([rx, ry, rz], axis=1))
+    
+    result = []
+    for m in matrices:
+        sy = min(max(-m[0][2], -1.0), 1.0)
+        if abs(sy) > 0.999999:
+            rx, rz = math.atan2(-m[2][1], m[1][1]), 0.0
+        else:
+            rx, rz = math.atan2(m[1][2], m[2][2]), math.atan2(m[0][1], m[0][0])
+        result.append([math.degrees(rx), math.degrees(math.asin(sy)), math.degrees(rz)])
+    return result
+
+def aimMatrices(directions, aimAxes, upAxes, worldUps):
+    # Rotate aim axis onto direction, and up axis as close as possible to world up
+    # same as an aimConstraint with worldUpType vector
+    if np is not None:
+        def unit(v):
+            length = np.linalg.norm(v, axis=1)[:, None]
+            return np.divide(v, length, out=np.zeros_like(v), where=length > 1e-12)
+        def frame(aim, up):
+            x = unit(aim)
+            z = unit(np.cross(x, up))
+            # up parallel to aim, use any perpendicular axis
+            parallel = ~z.any(axis=1)
+            if parallel.any():
+                other = np.where(np.abs(x[parallel, 1:2]) < 0.99, [[0.0, 1.0, 0.0]], [[0.0, 0.0, 1.0]])
+                z[parallel] = unit(np.cross(x[parallel], other))
+            return np.stack([x, np.cross(z, x), z], axis=1)
+        
+        shape = (-1, 3)
+        objectFrame = frame(np.asarray(aimAxes, dtype=np.float64).reshape(shape), np.asarray(upAxes, dtype=np.float64).reshape(shape))
+        worldFrame = frame(np.asarray(directions, dtype=np.float64).reshape(shape), np.asarray(worldUps, dtype=np.float64).reshape(shape))
+        return np.einsum('nji,njk->nik', objectFrame, worldFrame)
+    
+    def frame(aim, up):
+        x = normalize(aim)
+        z = normalize(cross(x, up))
+        if z == (0.0, 0.0, 0.0):
+            z = normalize(cross(x, (0, 1, 0) if abs(x[1]) < 0.99 else (0, 0, 1)))
+        return [x, cross(z, x), z]
+    
+    result = []
+    for direction, aimAxis, upAxis, worldUp in zip(directions, aimAxes, upAxes, worldUps):
+        objectFrame = frame(aimAxis, upAxis)
+        worldFrame = frame(direction, worldUp)
+        transposed = [[objectFrame[c][r] for c in range(3)] for r in range(3)]
+        result.append(multMatrix3(transposed, worldFrame))
+    return result
+
+def transformPoints(points, matrix, translate=True):
+    # Multiply row vectors by a 4x4 matrix, without translate for directions
+    if np is not None:
+        m = np.asarray(matrix, dtype=np.float64).reshape(4, 4)
+        result = np.asarray(points, dtype=np.float64).reshape(-1, 3).dot(m[:3, :3])
+        if translate:
+            result += m[3, :3]
+        return result
+    
+    m = [list(row) for row in matrix]
+    offset = m[3][:3] if translate else (0.0, 0.0, 0.0)
+    return [
+        [p[0]*m[0][c] + p[1]*m[1][c] + p[2]*m[2][c] + offset[c] for c in range(3)] 
+        for p in points
+    ]
+
+def transformVectors(vectors, matrix):
+    return transformPoints(vectors, matrix, translate=False)
+
+def pointMatrixMult(m1, m2):
+    # Same result as the mel pointMatrixMult procedure
+    return transformPoints([m1], m2)[0]
+
+def eulerToQuaternions(eulers):
+    # 'xyz' euler in degrees to (x, y, z, w), x is applied first so q = qz * qy * qx
+    if np is not None:
+        half = np.radians(np.asarray(eulers, dtype=np.float64).reshape(-1, 3)) / 2
+        cx, cy, cz = np.cos(half).T
+        sx, sy, sz = np.sin(half).T
+        return np.stack([
+            sx*cy*cz - cx*sy*sz,
+            cx*sy*cz + sx*cy*sz,
+            cx*cy*sz - sx*sy*cz,
+            cx*cy*cz + sx*sy*sz,
+        ], axis=1)
+    
+    result = []
+    for euler in eulers:
+        cx, cy, cz = [math.cos(math.radians(v)/2) for v in euler]
+        sx, sy, sz = [math.sin(math.radians(v)/2) for v in euler]
+        result.append([
+            sx*cy*cz - cx*sy*sz,
+            cx*sy*cz + sx*cy*sz,
+            cx*cy*sz - sx*sy*cz,
+            cx*cy*cz + sx*sy*sz,
+        ])
+    return result
+
+def vectorArray(values):
+    # Per particle doubles or vectors as an (n, 3) array, a double is used on every axis
+    # vectors are read flat, the only part of the numpy path that still holds the GIL
+    try:
+        if not isinstance(values, np.ndarray) and len(values) and not isinstance(values[0], float):
+            return np.fromiter(itertools.chain.from_iterable(values), dtype=np.float64, count=len(values)*3).reshape(-1, 3)
+        array = np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        array = np.asarray([(v, v, v) if isinstance(v, float) else v for v in values], dtype=np.float64)
+    if array.ndim == 1:
+        array = np.repeat(array[:, None], 3, axis=1)
+    return array.reshape(-1, 3)
+
+def scalarArray(values):
+    # Per particle doubles, or the first component of vectors, as an (n,) array
+    try:
+        array = np.asarray(values, dtype=np.float64)
+    except ValueError:
+        array = np.asarray([v if isinstance(v, float) else v[0] for v in values], dtype=np.float64)
+    if array.ndim > 1:
+        array = array.reshape(len(array), -1)[:, 0]
+    return array
+
+def solveRotations(rotationTypes, rotations, directions, aimAxes, upAxes, worldUps, order='xyz', radians=False):
+    # Instancer rotation per particle, type 0 rotation, 1 aim direction, 2 aim position
+    # returns 'xyz' euler in degrees, None where no rotation is instanced, zeros with numpy
+    if np is not None:
+        rotationTypes = np.asarray(rotationTypes)
+        eulers = np.zeros((len(rotationTypes), 3))
+        rotMask = rotationTypes == 0
+        if rotMask.any():
+            values = vectorArray(rotations)[rotMask]
+            if order == 'xyz' and not radians:
+                eulers[rotMask] = values
+            else:
+                if not radians:
+                    values = np.radians(values)
+                eulers[rotMask] = matricesToEuler(eulerToMatrices(values, order))
+        aimMask = (rotationTypes == 1) | (rotationTypes == 2)
+        if aimMask.any():
+            eulers[aimMask] = matricesToEuler(aimMatrices(
+                vectorArray(directions)[aimMask], vectorArray(aimAxes)[aimMask], 
+                vectorArray(upAxes)[aimMask], vectorArray(worldUps)[aimMask]
+            ))
+        return eulers
+    
+    count = len(rotationTypes)
+    eulers = [None] * count
+    
+    rotIds = [i for i in range(count) if rotationTypes[i] == 0]
+    if rotIds:
+        values = [rotations[i] for i in rotIds]
+        if order == 'xyz' and not radians:
+            solved = values
+        else:
+            if not radians:
+                values = [[math.radians(v) for v in value] for value in values]
+            solved = matricesToEuler(eulerToMatrices(values, order))
+        for i, euler in zip(rotIds, solved):
+            eulers[i] = euler
+    
+    aimIds = [i for i in range(count) if rotationTypes[i] in (1, 2)]
+    if aimIds:
+        solved = matricesToEuler(aimMatrices(
+            [directions[i] for i in aimIds], [aimAxes[i] for i in aimIds], 
+            [upAxes[i] for i in aimIds], [worldUps[i] for i in aimIds]
+        ))
+        for i, euler in zip(aimIds, solved):
+            eulers[i] = euler
+    return eulers
 
 ### Maya Command
 
@@ -33,174 +298,1033 @@ def undoOn(function):
         return result
     return funcCall
 
-def pointMatrixMult(m1, m2):
+def melPointMatrixMult(m1, m2):
     return mel.eval('pointMatrixMult ({%s}, {%s});' %(
         ", ".join([str(a) for a in m1]), 
         ", ".join([str(a) for a in [v for x in m2 for v in x]]), 
     ))
 
-def bakeNParticles(nParticles=pm.ls(type='nParticle'), 
-            startFrame = int(pm.playbackOptions(q=True, min=True)), 
-            endFrame   = int(pm.playbackOptions(q=True, max=True))
+def getParticleArray(nPtc, attr, count, default=None):
+    # Read a whole per particle attribute in one call, vectors as tuples and doubles as floats
+    if not attr:
+        return [default] * count
+    values = cmds.getAttr('%s.%s' %(nPtc, attr)) or []
+    if len(values) < count:
+        values = list(values) + [default] * (count - len(values))
+    return values
+
+def getInstancerSettings(nPtc):
+    pInst = pm.particleInstancer(nPtc, q=True, name=True)
+    if not pInst:
+        return None
+    pInst = pm.ls(pInst)[0]
+    settings = {'instancer': pInst}
+    for key, flag in [
+        ('objects', 'object'), ('rotation', 'rotation'), ('rotationType', 'rotationType'), 
+        ('position', 'position'), ('objectIndex', 'objectIndex'), ('scale', 'scale'), 
+        ('aimDirection', 'aimDirection'), ('aimPosition', 'aimPosition'), ('aimAxis', 'aimAxis'), 
+        ('aimUpAxis', 'aimUpAxis'), ('aimWorldUp', 'aimWorldUp'),
+    ]:
+        settings[key] = mel.eval("particleInstancer -name {instancer} -q -{flag} {particle}".format(
+                            instancer = pInst, flag = flag, particle = nPtc))
+    
+    # The instancer enum is read from the node, it does not follow transform.rotateOrder
+    rotateOrders = parseRotateOrders(cmds.attributeQuery('rotationOrder', node=pInst.name(), listEnum=True)[0])
+    settings['rotationOrder'] = rotateOrders.get(pInst.rotationOrder.get(), 'xyz')
+    settings['rotationRadians'] = pInst.rotationAngleUnits.get() == 1
+    if settings['rotation']:
+        settings['defaultRotationType'] = 0
+    elif settings['aimDirection']:
+        settings['defaultRotationType'] = 1
+    elif settings['aimPosition']:
+        settings['defaultRotationType'] = 2
+    else:
+        settings['defaultRotationType'] = None
+    return settings
+
+def captureFrame(nPtc, settings):
+    # Main thread stage, raw per particle arrays of the current frame
+    pCount = pm.nParticle(nPtc, q=True, ct=True)
+    raw = {'count': pCount}
+    for key, attr, default in [
+        ('ids', 'particleId', 0.0), 
+        ('positions', settings['position'], (0,0,0)), 
+        ('rotations', settings['rotation'], (0,0,0)), 
+        ('scales', settings['scale'], (1,1,1)), 
+        ('indices', settings['objectIndex'], 0.0), 
+        ('aimDirections', settings['aimDirection'], (1,0,0)), 
+        ('aimPositions', settings['aimPosition'], (0,0,0)), 
+        ('aimAxes', settings['aimAxis'], (1,0,0)), 
+        ('aimUpAxes', settings['aimUpAxis'], (0,1,0)), 
+        ('aimWorldUps', settings['aimWorldUp'], (0,1,0)), 
+        ('rotationTypes', settings['rotationType'], 0.0),
+    ]:
+        raw[key] = getParticleArray(nPtc, attr, pCount, default)
+    
+    # Instancer matrix is read once per frame
+    raw['matrix'] = [list(row) for row in pm.getAttr( settings['instancer']+".worldMatrix")]
+    return raw
+
+def processFrame(raw, settings):
+    # Pure math stage, safe to run on a worker thread
+    # with numpy every step works on whole arrays, so the workers spend their time outside the GIL
+    pCount = raw['count']
+    positions = raw['positions']
+    matrix = raw['matrix']
+    lastObject = len(settings['objects']) - 1
+    
+    if np is not None:
+        positions = vectorArray(positions)
+        if settings['rotationType']:
+            rotationTypes = scalarArray(raw['rotationTypes']).astype(np.int32)
+        else:
+            defaultType = settings['defaultRotationType']
+            rotationTypes = np.full(pCount, -1 if defaultType is None else defaultType, dtype=np.int32)
+        
+        directions = vectorArray(raw['aimDirections'])
+        aimed = rotationTypes == 2
+        if aimed.any():
+            directions[aimed] = vectorArray(raw['aimPositions'])[aimed] - positions[aimed]
+        
+        eulers = solveRotations(
+            rotationTypes, raw['rotations'], directions, 
+            transformVectors(vectorArray(raw['aimAxes']), matrix), transformVectors(vectorArray(raw['aimUpAxes']), matrix), 
+            transformVectors(vectorArray(raw['aimWorldUps']), matrix), 
+            order=settings['rotationOrder'], radians=settings['rotationRadians']
+        )
+        return {
+            'count': pCount,
+            'ids': scalarArray(raw['ids']).astype(np.int32),
+            'positions': positions,
+            'eulers': eulers,
+            'scales': vectorArray(raw['scales']),
+            'objectIndices': np.clip(scalarArray(raw['indices']).astype(np.int32), 0, lastObject),
+        }
+    
+    if settings['rotationType']:
+        rotationTypes = [int(t if isinstance(t, float) else t[0]) for t in raw['rotationTypes']]
+    else:
+        rotationTypes = [settings['defaultRotationType']] * pCount
+    
+    rotationValues = []
+    directions = []
+    for i in range(pCount):
+        rot = raw['rotations'][i]
+        if isinstance(rot, float):
+            rot = (rot, rot, rot)
+        rotationValues.append(rot)
+        
+        if rotationTypes[i] == 2:
+            directions.append([a - p for a, p in zip(raw['aimPositions'][i], positions[i])])
+        else:
+            directions.append(raw['aimDirections'][i])
+    
+    # Axes are directions, only the rotation and scale of the instancer apply
+    eulers = solveRotations(
+        rotationTypes, rotationValues, directions, 
+        transformVectors(raw['aimAxes'], matrix), transformVectors(raw['aimUpAxes'], matrix), transformVectors(raw['aimWorldUps'], matrix), 
+        order=settings['rotationOrder'], radians=settings['rotationRadians']
+    )
+    
+    return {
+        'count': pCount,
+        'ids': [int(i) for i in raw['ids']],
+        'positions': [tuple(p) for p in positions],
+        'eulers': eulers,
+        'scales': [(v, v, v) if isinstance(v, float) else tuple(v) for v in raw['scales']],
+        'objectIndices': [min(max(int(v if isinstance(v, float) else v[0]), 0), lastObject) for v in raw['indices']],
+    }
+
+class WorkerPool(object):
+    # Ordered map on a thread pool, concurrent.futures when available
+    def __init__(self, workers=None):
+        self.workers = max(int(workers or multiprocessing.cpu_count()), 1)
+        self.pool = None
+        if self.workers > 1:
+            if ThreadPoolExecutor is not None:
+                self.pool = ThreadPoolExecutor(max_workers=self.workers)
+            else:
+                self.pool = ThreadPool(self.workers)
+        
+    def map(self, function, items):
+        if self.pool is None:
+            return [function(item) for item in items]
+        return list(self.pool.map(function, items))
+        
+    def close(self):
+        if self.pool is None:
+            return
+        if ThreadPoolExecutor is not None:
+            self.pool.shutdown()
+        else:
+            self.pool.close()
+            self.pool.join()
+        self.pool = None
+
+def encodeFrame(frame, data):
+    # One frame block of the instance cache
+    count = data['count']
+    if np is not None:
+        return b''.join([
+            struct.pack('<dI', frame, count),
+            np.asarray(data['ids'], dtype='<i4').tobytes(),
+            np.asarray(data['positions'], dtype='<f4').tobytes(),
+            eulerToQuaternions(data['eulers']).astype('<f4').tobytes(),
+            np.asarray(data['scales'], dtype='<f4').tobytes(),
+            np.asarray(data['objectIndices'], dtype='<i4').tobytes(),
+        ])
+    
+    orientations = eulerToQuaternions([e if e is not None else (0,0,0) for e in data['eulers']])
+    return b''.join([
+        struct.pack('<dI', frame, count),
+        struct.pack('<%di' %count, *data['ids']),
+        struct.pack('<%df' %(count*3), *[v for p in data['positions'] for v in p]),
+        struct.pack('<%df' %(count*4), *[v for q in orientations for v in q]),
+        struct.pack('<%df' %(count*3), *[v for p in data['scales'] for v in p]),
+        struct.pack('<%di' %count, *data['objectIndices']),
+    ])
+
+KEY_ATTRS = ['tx', 'ty', 'tz', 'rx', 'ry', 'rz', 'sx', 'sy', 'sz', 'v']
+KEY_TOLERANCE = 1e-5
+
+def frameChannels(data):
+    # Keyed values of a processed frame, one row of KEY_ATTRS per particle
+    if np is not None:
+        return np.hstack([data['positions'], data['eulers'], data['scales'], np.ones((data['count'], 1))])
+    return [
+        list(p) + list(e if e is not None else (0,0,0)) + list(s) + [1] 
+        for p, e, s in zip(data['positions'], data['eulers'], data['scales'])
+    ]
+
+def reduceChannel(values, tolerance=KEY_TOLERANCE):
+    # values[frame][particle] over consecutive frames, None or nan where the particle is not alive
+    # a key is dropped when it lies on the line between both neighbours, keys are linear so the curve is unchanged
+    # the first and last frame of a chunk are always kept, so chunks reduce independently
+    if np is not None:
+        keep = np.ones(values.shape, dtype=bool)
+        if len(values) > 2:
+            # nan never compares below the tolerance, birth and death frames keep their key
+            keep[1:-1] = ~(np.abs(values[:-2] - 2*values[1:-1] + values[2:]) <= tolerance)
+        return keep
+    
+    keep = [[True] * len(row) for row in values]
+    for t in range(1, len(values)-1):
+        for n, (a, b, c) in enumerate(zip(values[t-1], values[t], values[t+1])):
+            if a is not None and b is not None and c is not None and abs(a - 2*b + c) <= tolerance:
+                keep[t][n] = False
+    return keep
+
+def reduceKeys(results, pool, tolerance=KEY_TOLERANCE):
+    # Second worker stage of a transform bake, which KEY_ATTRS to key for each particle of each frame
+    # the processed frames of a chunk are laid out per particle id and every channel is a pool task
+    frameCount = len(results)
+    if np is not None:
+        allIds = np.unique(np.concatenate([np.asarray(data['ids'], dtype=np.int64) for data in results]))
+        columns = [np.searchsorted(allIds, data['ids']) for data in results]
+        values = np.full((frameCount, len(allIds), len(KEY_ATTRS)), np.nan)
+        for t, data in enumerate(results):
+            values[t, columns[t]] = frameChannels(data)
+        keep = np.stack(pool.map(lambda c: reduceChannel(values[:, :, c], tolerance), range(len(KEY_ATTRS))), axis=-1)
+        return [keep[t, columns[t]] for t in range(frameCount)]
+    
+    allIds = sorted(set(i for data in results for i in data['ids']))
+    lookup = dict((i, n) for n, i in enumerate(allIds))
+    columns = [[lookup[i] for i in data['ids']] for data in results]
+    values = [[[None] * len(allIds) for t in range(frameCount)] for c in KEY_ATTRS]
+    for t, data in enumerate(results):
+        for n, row in zip(columns[t], frameChannels(data)):
+            for c, value in enumerate(row):
+                values[c][t][n] = value
+    keep = pool.map(lambda channel: reduceChannel(channel, tolerance), values)
+    return [[[keep[c][t][n] for c in range(len(KEY_ATTRS))] for n in columns[t]] for t in range(frameCount)]
+
+def getPlug(node, attr):
+    selection = om.MSelectionList()
+    selection.add(node)
+    mObject = om.MObject()
+    selection.getDependNode(0, mObject)
+    return om.MFnDependencyNode(mObject).findPlug(attr, False)
+
+class CurveKeyWriter(object):
+    # Keys buffered per node and attribute, then written as whole curves with one MFnAnimCurve.addKeys each
+    # values are what setKeyframe takes, ui units and rotations in degrees, keys are linear and visibility steps
+    # the first write of a curve that already exists replaces its keys from startFrame to endFrame
+    def __init__(self, startFrame, endFrame, maxKeys=2000000):
+        self.startFrame = startFrame
+        self.endFrame = endFrame
+        self.maxKeys = maxKeys
+        self.keys = {}
+        self.count = 0
+        self.written = set()
+        
+    def add(self, node, attr, frame, value):
+        frames, values = self.keys.setdefault((node, attr), ([], []))
+        frames.append(frame)
+        values.append(value)
+        self.count += 1
+        
+    def isFull(self):
+        return self.count >= self.maxKeys
+        
+    def flush(self):
+        distance = om.MDistance.uiToInternal(1.0)
+        for (node, attr), (frames, values) in self.keys.items():
+            if attr in ('tx', 'ty', 'tz'):
+                scale = distance
+            elif attr in ('rx', 'ry', 'rz'):
+                scale = math.pi / 180
+            else:
+                scale = 1.0
+            times = om.MTimeArray()
+            keyValues = om.MDoubleArray()
+            for frame, value in sorted(zip(frames, values)):
+                times.append(om.MTime(frame, om.MTime.uiUnit()))
+                keyValues.append(value * scale)
+            
+            plug = getPlug(node, attr)
+            sources = om.MPlugArray()
+            plug.connectedTo(sources, True, False)
+            existing = sources.length() and sources[0].node().hasFn(om.MFn.kAnimCurve)
+            fnCurve = om.MFnAnimCurve()
+            if existing:
+                fnCurve.setObject(sources[0].node())
+                if (node, attr) not in self.written:
+                    first, last = om.MTime(self.startFrame, om.MTime.uiUnit()), om.MTime(self.endFrame, om.MTime.uiUnit())
+                    for k in reversed(range(fnCurve.numKeys())):
+                        if first <= fnCurve.time(k) <= last:
+                            fnCurve.remove(k)
+            else:
+                fnCurve.create(plug)
+            self.written.add((node, attr))
+            tangent = om.MFnAnimCurve.kTangentStep if attr == 'v' else om.MFnAnimCurve.kTangentLinear
+            fnCurve.addKeys(times, keyValues, tangent, tangent, bool(existing))
+        self.keys = {}
+        self.count = 0
+
+class InstanceCacheWriter(object):
+    # Compact little endian point cache, written one frame at a time
+    # header : 'NPIC', version uint32, json length uint32, json {particle, objects}
+    # frame  : frame float64, count uint32, ids int32[n], positions float32[n*3], 
+    #          orientations float32[n*4] (x, y, z, w), scales float32[n*3], objectIndices int32[n]
+    magic = b'NPIC'
+    version = 1
+    
+    def __init__(self, path, particle='', objects=[], offset=None):
+        self.path = path
+        if offset:
+            # Resume, drop anything written after the last checkpoint
+            self.file = open(path, 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+            return
+        self.file = open(path, 'wb')
+        header = json.dumps({'particle': particle, 'objects': list(objects)}).encode('utf-8')
+        self.file.write(self.magic + struct.pack('<II', self.version, len(header)) + header)
+        
+    def writeEncoded(self, block):
+        self.file.write(block)
+        
+    def tell(self):
+        self.file.flush()
+        return self.file.tell()
+        
+    def close(self):
+        self.file.close()
+
+def readInstanceCache(path):
+    # Yield (frame, data) for every frame, only one frame is held in memory
+    def read(f, fmt):
+        size = struct.calcsize(fmt)
+        return struct.unpack(fmt, f.read(size))
+    
+    with open(path, 'rb') as f:
+        if f.read(4) != InstanceCacheWriter.magic:
+            raise IOError("%s is not an instance cache" %path)
+        version, length = read(f, '<II')
+        header = json.loads(f.read(length).decode('utf-8'))
+        while True:
+            chunk = f.read(struct.calcsize('<dI'))
+            if not chunk:
+                break
+            frame, count = struct.unpack('<dI', chunk)
+            ids = read(f, '<%di' %count)
+            positions = read(f, '<%df' %(count*3))
+            orientations = read(f, '<%df' %(count*4))
+            scales = read(f, '<%df' %(count*3))
+            objectIndices = read(f, '<%di' %count)
+            yield frame, {
+                'particle': header['particle'],
+                'objects': header['objects'],
+                'count': count,
+                'ids': list(ids),
+                'positions': [positions[i:i+3] for i in range(0, count*3, 3)],
+                'orientations': [orientations[i:i+4] for i in range(0, count*4, 4)],
+                'scales': [scales[i:i+3] for i in range(0, count*3, 3)],
+                'objectIndices': list(objectIndices),
+            }
+
+class BakeFrameWriter(object):
+    # Binary sidecar of a resumable transform bake, the processed frames so a resume can key them again
+    # without simulating, the keys of a crashed session are not in the reopened scene
+    # frame : frame float64, count uint32, ids int32[n], objectIndices int32[n], 
+    #         channels float64[n*9] (tx, ty, tz, rx, ry, rz, sx, sy, sz)
+    def __init__(self, path, offset=None):
+        self.path = path
+        if offset:
+            self.file = open(path, 'r+b')
+            self.file.truncate(offset)
+            self.file.seek(offset)
+        else:
+            self.file = open(path, 'wb')
+        
+    def writeFrame(self, frame, data):
+        count = data['count']
+        if np is not None:
+            block = [
+                np.asarray(data['ids'], dtype='<i4').tobytes(), 
+                np.asarray(data['objectIndices'], dtype='<i4').tobytes(),
+                np.asarray(frameChannels(data)[:, :9], dtype='<f8').tobytes(),
+            ]
+        else:
+            block = [
+                struct.pack('<%di' %count, *data['ids']), 
+                struct.pack('<%di' %count, *data['objectIndices']),
+                struct.pack('<%dd' %(count*9), *[v for row in frameChannels(data) for v in row[:9]]),
+            ]
+        self.file.write(struct.pack('<dI', frame, count) + b''.join(block))
+        
+    def tell(self):
+        self.file.flush()
+        return self.file.tell()
+        
+    def close(self):
+        self.file.close()
+
+def readBakeFrames(path, end, channels=True):
+    # Yield (frame, data) up to the offset of the last checkpoint, one frame at a time
+    # without channels only the ids and object indices are read
+    with open(path, 'rb') as f:
+        while f.tell() < end:
+            frame, count = struct.unpack('<dI', f.read(struct.calcsize('<dI')))
+            data = {
+                'count': count,
+                'ids': list(struct.unpack('<%di' %count, f.read(4*count))),
+                'objectIndices': list(struct.unpack('<%di' %count, f.read(4*count))),
+            }
+            if not channels:
+                f.seek(8*9*count, 1)
+            elif np is not None:
+                values = np.frombuffer(f.read(8*9*count), dtype='<f8').reshape(count, 9)
+                data.update(positions=values[:, 0:3], eulers=values[:, 3:6], scales=values[:, 6:9])
+            else:
+                values = struct.unpack('<%dd' %(count*9), f.read(8*9*count))
+                rows = [values[i:i+9] for i in range(0, count*9, 9)]
+                data.update(positions=[r[0:3] for r in rows], eulers=[r[3:6] for r in rows], scales=[r[6:9] for r in rows])
+            yield int(frame), data
+
+def getStateAttrs(nPtc):
+    # Per particle attributes that have an initial state, what the solver starts from
+    attrs = cmds.nParticle(nPtc, q=True, perParticleAttribute=True) or []
+    return [attr for attr in attrs if cmds.attributeQuery(attr + '0', node=nPtc, exists=True)]
+
+def writeParticleState(path, nPtc, frame):
+    # Per particle state of the current frame, replaced after every chunk so a resume can start the solver there
+    header = {'frame': frame, 'attrs': []}
+    if cmds.attributeQuery('nextId0', node=nPtc, exists=True):
+        header['nextId'] = cmds.getAttr(nPtc + '.nextId')
+    blocks = []
+    for attr in getStateAttrs(nPtc):
+        values = cmds.getAttr('%s.%s' %(nPtc, attr)) or []
+        vector = bool(values) and not isinstance(values[0], float)
+        flat = [v for value in values for v in value] if vector else list(values)
+        header['attrs'].append([attr, 3 if vector else 1, len(values)])
+        blocks.append(struct.pack('<%dd' %len(flat), *flat))
+    
+    data = json.dumps(header).encode('utf-8')
+    with open(path + '.tmp', 'wb') as f:
+        f.write(b'NPST' + struct.pack('<I', len(data)) + data + b''.join(blocks))
+    if os.path.isfile(path):
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+def readParticleState(path):
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        if f.read(4) != b'NPST':
+            return None
+        length, = struct.unpack('<I', f.read(4))
+        state = json.loads(f.read(length).decode('utf-8'))
+        values = {}
+        for attr, components, count in state['attrs']:
+            values[attr] = struct.unpack('<%dd' %(components*count), f.read(8*components*count))
+        state['values'] = values
+    return state
+
+def setParticleArray(plug, components, flat):
+    count = len(flat) // components
+    if components == 3:
+        cmds.setAttr(plug, count, *[tuple(flat[i:i+3]) for i in range(0, len(flat), 3)], type='vectorArray')
+    else:
+        cmds.setAttr(plug, list(flat), type='doubleArray')
+
+def restartSolver(nPtc, state):
+    # Start the solver at the state frame, the saved arrays become the initial state and the nucleus starts there
+    # returns a function that puts the original initial state and start frame back
+    nucleus = (cmds.listConnections(nPtc + '.currentState', type='nucleus') or [None])[0]
+    if not nucleus:
+        return None
+    
+    previous = []
+    for attr, components, count in state['attrs']:
+        plug = '%s.%s0' %(nPtc, attr)
+        values = cmds.getAttr(plug) or []
+        flat = [v for value in values for v in value] if components == 3 else list(values)
+        previous.append((plug, components, flat))
+        setParticleArray(plug, components, state['values'][attr])
+    if 'nextId' in state:
+        previous.append((nPtc + '.nextId0', 0, cmds.getAttr(nPtc + '.nextId0')))
+        cmds.setAttr(nPtc + '.nextId0', state['nextId'])
+    previous.append((nucleus + '.startFrame', 0, cmds.getAttr(nucleus + '.startFrame')))
+    cmds.setAttr(nucleus + '.startFrame', state['frame'])
+    pm.currentTime(state['frame'])
+    
+    def restore():
+        for plug, components, value in previous:
+            if components:
+                setParticleArray(plug, components, value)
+            else:
+                cmds.setAttr(plug, value)
+    return restore
+
+class BakeCheckpoint(object):
+    # Sidecar of a chunked bake, json lines with a header then one line per completed chunk
+    # a chunk only holds its frames and the offset reached in the cache or bake frame file
+    # the header line also holds an id, stamped on what the bake writes in the scene
+    def __init__(self, path, header):
+        self.path = path
+        self.header = header
+        self.id = None
+        self.chunks = []
+        self.lastFrame = None
+        self.size = 0
+        self.file = None
+        
+    def load(self):
+        # Completed chunks of a previous bake with the same header, read line by line
+        # a partly written line ends the valid part
+        self.reset()
+        if os.path.isfile(self.path):
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        item = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        break
+                    if not self.size:
+                        checkpointId = item.pop('id', None)
+                        if item != self.header:
+                            break
+                        self.id = checkpointId
+                    else:
+                        self.chunks.append(item)
+                    self.size += len(line)
+        self.lastFrame = self.chunks[-1]['frames'][-1] if self.chunks else None
+        return self.chunks
+        
+    def reset(self):
+        # Start over, the next open rewrites the header with a new id
+        self.id = None
+        self.chunks = []
+        self.lastFrame = None
+        self.size = 0
+        return self.chunks
+        
+    def open(self):
+        # New chunks are appended after the last complete line
+        if self.size:
+            self.file = open(self.path, 'r+b')
+            self.file.truncate(self.size)
+            self.file.seek(self.size)
+        else:
+            self.file = open(self.path, 'wb')
+            self.id = uuid.uuid4().hex
+            self.writeLine(dict(self.header, id=self.id))
+        self.chunks = []
+        
+    def write(self, chunk):
+        self.writeLine(chunk)
+        self.lastFrame = chunk['frames'][-1]
+        
+    def writeLine(self, item):
+        self.file.write((json.dumps(item) + '\n').encode('utf-8'))
+        self.file.flush()
+        
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
+            
+    def remove(self, *paths):
+        # The checkpoint and the sidecars written with it
+        self.close()
+        for path in (self.path,) + paths:
+            if os.path.isfile(path):
+                os.remove(path)
+
+class InstanceRegistry(object):
+    # Baked instances keyed by the stable particleId, with the frame intervals each id is alive
+    # existing are the children of a resumed bake group, nodes of other bakes with the same name are left alone
+    def __init__(self, prefix, objects=[], existing=[]):
+        self.prefix = prefix
+        self.objects = objects
+        self.existing = dict((path.split('|')[-1], path) for path in existing or [])
+        self.created = []
+        self.instances = {}
+        self.intervals = {}
+        
+    def getName(self, particleId):
+        return "%s_geo_%04d" %(self.prefix, particleId)
+        
+
+    def update(self, frame, ids, objectIndices):
+        # Create instances for the ids born this frame, one pass for all of them
+        born = set(ids).difference(self.instances)
+        if born:
+            for particleId, objectIndex in zip(ids, objectIndices):
+                if particleId not in born:
+                    continue
+                instName = self.getName(particleId)
+                if instName in self.existing:
+                    self.instances[particleId] = self.existing[instName]
+                else:
+                    instObject = cmds.duplicate(self.objects[objectIndex], name=instName, rr=True, instanceLeaf=True)[0]
+                    cmds.xform(instObject, ztp=True, wd=True, ws=True, cp=True, p=1)
+                    self.instances[particleId] = instObject
+                    self.created.append(particleId)
+                born.discard(particleId)
+        
+        for particleId in ids:
+            intervals = self.intervals.setdefault(particleId, [])
+            if intervals and intervals[-1][1] == frame - 1:
+                intervals[-1][1] = frame
+            elif not intervals or intervals[-1][1] != frame:
+                intervals.append([frame, frame])
+        
+    def hiddenFrames(self, particleId):
+        # Frames just outside each alive interval, where the instance must be hidden
+        intervals = self.intervals.get(particleId, [])
+        alive = set()
+        for start, end in intervals:
+            alive.update((start, end))
+        hidden = set()
+        for start, end in intervals:
+            hidden.update((start-1, end+1))
+        return sorted(hidden.difference(alive))
+
+class NodeTypeIndex(object):
+    # Scene nodes by type, listed once then kept current with node added/removed callbacks
+    # handles are stored so renamed and reparented nodes stay valid
+    def __init__(self):
+        self.handles = {}
+        self.callbacks = []
+        
+    def ls(self, nodeType):
+        if nodeType not in self.handles:
+            self.handles[nodeType] = {}
+            selection = om.MSelectionList()
+            for node in cmds.ls(type=nodeType) or []:
+                selection.add(node)
+            for i in range(selection.length()):
+                mObject = om.MObject()
+                selection.getDependNode(i, mObject)
+                self.addNode(mObject, nodeType)
+            self.callbacks.append(om.MDGMessage.addNodeAddedCallback(self.addNode, nodeType, nodeType))
+            self.callbacks.append(om.MDGMessage.addNodeRemovedCallback(self.removeNode, nodeType, nodeType))
+            if len(self.callbacks) == 2:
+                for message in [om.MSceneMessage.kAfterOpen, om.MSceneMessage.kAfterNew]:
+                    self.callbacks.append(om.MSceneMessage.addCallback(message, self.reset))
+        
+        names = []
+        for handle in self.handles[nodeType].values():
+            if not handle.isValid():
+                continue
+            mObject = handle.object()
+            if mObject.hasFn(om.MFn.kDagNode):
+                names.append(om.MFnDagNode(mObject).partialPathName())
+            else:
+                names.append(om.MFnDependencyNode(mObject).name())
+        return sorted(names)
+        
+    def addNode(self, mObject, nodeType):
+        handle = om.MObjectHandle(mObject)
+        self.handles.setdefault(nodeType, {})[handle.hashCode()] = handle
+        
+    def removeNode(self, mObject, nodeType):
+        self.handles.get(nodeType, {}).pop(om.MObjectHandle(mObject).hashCode(), None)
+        
+    def reset(self, *args):
+        # New scene, every type is listed again on its next query
+        self.removeCallbacks()
+        self.handles = {}
+        
+    def removeCallbacks(self):
+        for callback in self.callbacks:
+            try:
+                om.MMessage.removeCallback(callback)
+            except:
+                pass
+        self.callbacks = []
+
+nodeIndex = NodeTypeIndex()
+
+def stampBakeGroup(group, checkpointId, frame):
+    # The checkpoint a bake group belongs to, and the last frame whose keys are in the scene
+    if not cmds.attributeQuery('bakeCheckpoint', node=group, exists=True):
+        cmds.addAttr(group, ln='bakeCheckpoint', dt='string')
+        cmds.addAttr(group, ln='bakeFrame', at='double')
+    cmds.setAttr(group + '.bakeCheckpoint', checkpointId, type='string')
+    cmds.setAttr(group + '.bakeFrame', frame)
+
+def findBakeGroup(particle, checkpointId):
+    for group in cmds.ls(particle + '_BakedObjects*', type='transform') or []:
+        if cmds.attributeQuery('bakeCheckpoint', node=group, exists=True) and cmds.getAttr(group + '.bakeCheckpoint') == checkpointId:
+            return group
+    return None
+
+def bakeNParticles(nParticles=None, 
+            startFrame = None, 
+            endFrame   = None,
+            cacheDir   = None,
+            workers    = None,
+            checkpointDir = None,
+            progress   = None
         ):
-    for nPtc in nParticles:
-        pInst = pm.particleInstancer(nPtc, q=True, name=True)
-        instances = []
-        if pInst:
-            pInst = pm.ls(pInst)[0]
-            pName = nPtc
+    # With cacheDir the instances are streamed to a point cache instead of baked to transforms
+    # frames are captured on the main thread in chunks and processed on a pool of workers
+    # with checkpointDir every chunk is checkpointed, a cancelled or crashed bake resumes after the last one
+    # progress(done, total) is called after each chunk, returning False cancels the bake
+    # defaults are resolved here, every nParticle in the scene over the playback range
+    if nParticles is None:
+        nParticles = nodeIndex.ls('nParticle')
+    if startFrame is None:
+        startFrame = int(cmds.playbackOptions(q=True, min=True))
+    if endFrame is None:
+        endFrame = int(cmds.playbackOptions(q=True, max=True))
+    
+    pool = WorkerPool(workers)
+    batchSize = pool.workers * 2
+    frameCount = endFrame - startFrame + 1
+    total = len(nParticles) * frameCount
+    cancelled = False
+    try:
+        for index, nPtc in enumerate(nParticles):
+            settings = getInstancerSettings(nPtc)
+            if not settings:
+                continue
+            
             pTrans = pm.ls(nPtc)[0].getTransform().name()
-            objects            = mel.eval("particleInstancer -name {instancer} -q -object {particle}".format(
-                                instancer = pInst, particle = pName))
-            objectRotation     = mel.eval("particleInstancer -name {instancer} -q -rotation {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectRotationType = mel.eval("particleInstancer -name {instancer} -q -rotationType {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectPosition     = mel.eval("particleInstancer -name {instancer} -q -position {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectIndex        = mel.eval("particleInstancer -name {instancer} -q -objectIndex {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectScale        = mel.eval("particleInstancer -name {instancer} -q -scale {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectAimDir       = mel.eval("particleInstancer -name {instancer} -q -aimDirection {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectAimPos       = mel.eval("particleInstancer -name {instancer} -q -aimPosition {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectAimAxis      = mel.eval("particleInstancer -name {instancer} -q -aimAxis {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectAimUpAxis    = mel.eval("particleInstancer -name {instancer} -q -aimUpAxis {particle} ".format(
-                                instancer = pInst, particle = pName))
-            objectAimWorldUp   = mel.eval("particleInstancer -name {instancer} -q -aimWorldUp {particle} ".format(
-                                instancer = pInst, particle = pName))
-        
-            bakeGroup          = pm.group(w=True, n=pTrans+"_BakedObjects", em=True)
+            objects = settings['objects']
+            process = lambda raw: processFrame(raw, settings)
+            
+            checkpoint = None
+            chunks = []
+            if checkpointDir:
+                checkpoint = BakeCheckpoint(os.path.join(checkpointDir, pTrans + '.bake.jsonl').replace('\\', '/'), {
+                    'particle': pTrans, 'objects': [str(o) for o in objects], 
+                    'startFrame': startFrame, 'endFrame': endFrame, 'cache': bool(cacheDir),
+                })
+                chunks = checkpoint.load()
+                sidecarPath = os.path.splitext(checkpoint.path)[0]
+            resumeFrame = checkpoint.lastFrame if checkpoint else None
+            
+            if cacheDir:
+                cachePath = os.path.join(cacheDir, pTrans + '.npic').replace('\\', '/')
+                offset = chunks[-1]['offset'] if chunks and os.path.isfile(cachePath) else None
+                if chunks and not offset:
+                    chunks, resumeFrame = checkpoint.reset(), None
+                writer = InstanceCacheWriter(cachePath, particle=pTrans, objects=objects, offset=offset)
+                encode = lambda item: encodeFrame(item[0], processFrame(item[1], settings))
+            else:
+                # Keys only count as baked when the bake group carries this checkpoint and its last frame
+                # otherwise the completed chunks are keyed again from the sidecar, an older bake group is left alone
+                bakeGroup = None
+                replay = False
+                frameWriter = None
+                if checkpoint:
+                    framesPath = sidecarPath + '.frames'
+                    offset = chunks[-1]['offset'] if chunks and os.path.isfile(framesPath) else None
+                    if offset and os.path.getsize(framesPath) < offset:
+                        offset = None
+                    if chunks and not offset:
+                        chunks, resumeFrame = checkpoint.reset(), None
+                    if resumeFrame is not None:
+                        bakeGroup = findBakeGroup(pTrans, checkpoint.id)
+                        replay = not bakeGroup or cmds.getAttr(bakeGroup + '.bakeFrame') != resumeFrame
+                bakeGroup = bakeGroup or cmds.group(w=True, n=pTrans+"_BakedObjects", em=True)
+                registry = InstanceRegistry(pTrans, objects, existing=cmds.listRelatives(bakeGroup, c=True, f=True))
                 
-            for fr in range(startFrame, endFrame+1):
-                pm.currentTime(fr)
-                print("Baking %s | Frame %04d" %(nPtc, fr))
-                pCount = pm.nParticle(nPtc, q=True, ct=True)
-                for i in range(pCount):
-                    doubleAttrs = pm.nParticle(nPtc, q=True, ppd=True)
-                    vectorAttrs = pm.nParticle(nPtc, q=True, ppv=True)
-                    
-                    pos = pm.nParticle(nPtc, q=True, order=i, at=objectPosition)
+                def keyFrame(fr, data, keep=None):
+                    # keep from reduceKeys skips the redundant keys, linear tangents keep them redundant
+                    ids = [int(i) for i in data['ids']]
+                    registry.update(fr, ids, [int(i) for i in data['objectIndices']])
+                    channels = frameChannels(data)
+                    channels = channels.tolist() if hasattr(channels, 'tolist') else channels
+                    keep = keep.tolist() if hasattr(keep, 'tolist') else keep
+                    for i, values in enumerate(channels):
+                        instObject = registry.instances[ids[i]]
+                        for attr, value, needed in zip(KEY_ATTRS, values, keep[i] if keep is not None else [True] * len(KEY_ATTRS)):
+                            if needed:
+                                keys.add(instObject, attr, fr, value)
+                
+                # Keys are buffered and written per curve, the main thread never keys one frame at a time
+                # keys left on the instances of a replayed bake are replaced over the frames keyed now
+                firstKey = startFrame - 1 if resumeFrame is None or replay else int(resumeFrame) + 1
+                keys = CurveKeyWriter(firstKey, endFrame + 1)
+                if chunks:
+                    print("%s %s up to frame %04d" %("Keying" if replay else "Reading", nPtc, resumeFrame))
+                    completed = readBakeFrames(framesPath, offset, channels=replay)
+                    for chunk in chunks:
+                        items = [next(completed) for fr in chunk['frames']]
+                        if replay:
+                            results = [data for fr, data in items]
+                            for (fr, data), keep in zip(items, reduceKeys(results, pool)):
+                                keyFrame(fr, data, keep)
+                            if keys.isFull():
+                                keys.flush()
+                        else:
+                            for fr, data in items:
+                                registry.update(fr, data['ids'], data['objectIndices'])
+                    completed.close()
+                if checkpoint:
+                    frameWriter = BakeFrameWriter(framesPath, offset=offset)
+            
+            firstFrame = startFrame
+            restore = None
+            if resumeFrame is not None:
+                firstFrame = int(resumeFrame) + 1
+                print("Resuming %s from frame %04d" %(nPtc, firstFrame))
+                # The solver restarts from the state saved with the checkpoint when the scene is not already there
+                if cmds.currentTime(q=True) != resumeFrame:
+                    state = readParticleState(sidecarPath + '.state')
+                    if state and state['frame'] == resumeFrame:
+                        restore = restartSolver(nPtc, state)
+                    if not restore:
+                        print("No solver state saved at frame %04d, simulating %s from %04d" %(resumeFrame, nPtc, startFrame))
+                        for fr in range(startFrame, firstFrame):
+                            pm.currentTime(fr)
+            if checkpoint:
+                checkpoint.open()
+            
+            try:
+                for batchStart in range(firstFrame, endFrame+1, batchSize):
+                    frames = list(range(batchStart, min(batchStart+batchSize, endFrame+1)))
+                    raws = []
+                    for fr in frames:
+                        pm.currentTime(fr)
+                        print("Capturing %s | Frame %04d" %(nPtc, fr))
+                        raws.append(captureFrame(nPtc, settings))
                     
-                    if objectRotation:
-                        rot = pm.nParticle(nPtc, q=True, order=i, at=objectRotation)
-
-                    if objectScale:
-                        size = pm.nParticle(nPtc, q=True, order=i, at=objectScale)
+                    if cacheDir:
+                        for block in pool.map(encode, zip(frames, raws)):
+                            writer.writeEncoded(block)
+                        chunk = {'frames': frames, 'offset': writer.tell()}
                     else:
-                        size = (1,1,1)
+                        results = pool.map(process, raws)
+                        for fr, data, keep in zip(frames, results, reduceKeys(results, pool)):
+                            keyFrame(fr, data, keep)
+                            if frameWriter:
+                                frameWriter.writeFrame(fr, data)
+                        chunk = {'frames': frames, 'offset': frameWriter.tell() if frameWriter else 0}
+                        if keys.isFull():
+                            keys.flush()
+                            if checkpoint:
+                                stampBakeGroup(bakeGroup, checkpoint.id, frames[-1])
                     
-                    if objectIndex:
-                        s = pm.nParticle(nPtc, q=True, order=i, at=objectIndex)
-                        if isinstance(s, float):
-                            s = [s]
-                        sObjects = len(s)
-                        instanceIndex = int(s[0])
-                        if instanceIndex >= sObjects:
-                            instanceIndex = sObjects-1
-                    else:
-                        instanceIndex = 0
+                    if checkpoint:
+                        writeParticleState(sidecarPath + '.state', nPtc, frames[-1])
+                        checkpoint.write(chunk)
+                    if progress and progress(index * frameCount + frames[-1] - startFrame + 1, total) is False:
+                        cancelled = True
+                        break
+            finally:
+                if cacheDir:
+                    writer.close()
+                elif frameWriter:
+                    frameWriter.close()
+                if checkpoint:
+                    checkpoint.close()
+                if restore:
+                    restore()
+            
+            if not cancelled and checkpoint:
+                checkpoint.remove(sidecarPath + '.state', *([] if cacheDir else [framesPath]))
+            
+            if cacheDir:
+                if not cancelled:
+                    print("Instance cache written to %s" %cachePath)
+            else:
+                # Cleanup invisible frame, once every frame has been keyed
+                if not cancelled:
+                    for particleId, instObject in registry.instances.items():
+                        for fr in registry.hiddenFrames(particleId):
+                            for attr in ['sx', 'sy', 'sz', 'v']:
+                                keys.add(instObject, attr, fr, 0.0)
+                keys.flush()
+                if cancelled and checkpoint:
+                    stampBakeGroup(bakeGroup, checkpoint.id, checkpoint.lastFrame)
+                
+                pm.xform(bakeGroup, a=True, t=(0,0,0))
+                if registry.created:
+                    instances = cmds.parent([registry.instances[i] for i in registry.created], bakeGroup, a=True)
+                    registry.instances.update(zip(registry.created, instances))
+            
+            if cancelled:
+                print("Bake cancelled at frame %04d, run it again to resume" %frames[-1])
+                break
+    finally:
+        pool.close()
+    return not cancelled
 
-                    if objectAimDir:
-                        AimDirection = pm.nParticle(nPtc, q=True, order=i, at=objectAimDir)
-                        objAimDir = mel.eval('unit(<<%s>>)' %([str(i) for i in AimDirection]))
-                    else:
-                        AimDirection = (1,0,0)
-                        
-                    if objectAimPos:
-                        AimPosition = pm.nParticle(nPtc, q=True, order=i, at=objectAimPos)
-                    else:
-                        AimPosition = (0,0,0)
-                        
-                    if objectAimAxis:
-                        AimAxis = pm.nParticle(nPtc, q=True, order=i, at=objectAimAxis)
-                    else:
-                        AimAxis = (1,0,0)
-                        
-                    if objectAimUpAxis:
-                        AimUpAxis = pm.nParticle(nPtc, q=True, order=i, at=objectAimUpAxis)
-                    else:
-                        AimUpAxis = (0,1,0)
 
-                    if objectAimWorldUp:
-                        AimWorldUp = pm.nParticle(nPtc, q=True, order=i, at=objectAimWorldUp)
-                    else:
-                        AimWorldUp = (0,1,0)
+### Benchmark
 
-                    matrix = pm.getAttr( pInst+".worldMatrix")
-                    ObjAimAxis = pointMatrixMult (AimAxis, matrix)
-                    ObjAimUp = pointMatrixMult (AimUpAxis, matrix)
-                    ObjAimWup = pointMatrixMult (AimWorldUp, matrix)
+def testPointMatrixMult():
+    # Reference values computed by hand, and against mel when it is available
+    matrix = [[0, 1, 0, 0], [-2, 0, 0, 0], [0, 0, 3, 0], [10, 20, 30, 1]]
+    references = [
+        ((1, 0, 0), [10, 21, 30], [0, 1, 0]),
+        ((0, 1, 0), [8, 20, 30], [-2, 0, 0]),
+        ((1, 2, 3), [6, 21, 39], [-4, 1, 9]),
+    ]
+    for point, expectedPoint, expectedVector in references:
+        for result, expected in [
+            (transformPoints([point], matrix)[0], expectedPoint), 
+            (transformVectors([point], matrix)[0], expectedVector),
+            (melPointMatrixMult(point, matrix), expectedPoint),
+        ]:
+            if max(abs(a - b) for a, b in zip(result, expected)) > 1e-9:
+                raise AssertionError("%s * matrix = %s, expected %s" %(point, result, expected))
+    print("pointMatrixMult OK")
 
-                    instName = "%s_geo_%04d" %(pTrans, i)
-                    instObject = pm.ls(instName)
-                    if instObject:
-                        instObject = instObject[0]
-                    else:
-                        instObject = pm.duplicate(objects[instanceIndex], name=instName, rr=True, instanceLeaf=True)[0]
-                        
-                    if not instObject in instances:
-                        instances.append(instObject)
-                    
-                    if objectRotation:
-                        for rotAttr in doubleAttrs:
-                            if rotAttr == objectRotation:
-                                pm.xform(instObject, ro=(rot[0], rot[0], rot[0]))
-                        for rotAttr in vectorAttrs:
-                            if rotAttr == objectRotation:
-                                pm.xform(instObject, ro=rot)
-
-                    elif objectAimDir:
-                        pm.xform(instObject, ws=True, t=(0,0,0))
-                        pm.xform(instObject, ws=True, t=(0,0,0), a=True, sh=(0,0,0))
-                        pm.xform(bakeGroup, ws=True, t=objAimDir, a=True)
-                        pm.aimConstraint(
-                            bakeGroup, instObject, offset=(0,0,0), weight=1, aimVector=ObjAimAxis,
-                            upVector=ObjAimUp, worldUpType="vector", worldUpVector=ObjAimWup
-                        )
-                        pm.aimConstraint(bakeGroup, instObject, e=True, rm=True)
-                    elif objectAimPos:
-                        pm.xform(instObject, ws=True, t=(0,0,0))
-                        pm.xform(instObject, ws=True, t=pos, a=True, sh=(0,0,0))
-                        pm.xform(bakeGroup, ws=True, t=AimPosition, a=True, sh=(0,0,0))
-                        pm.aimConstraint(
-                            bakeGroup, instObject, offset=(0,0,0), weight=1, aimVector=ObjAimAxis,
-                            upVector=ObjAimUp, worldUpType="vector", worldUpVector=AimWorldUp
-                        )
-                        pm.aimConstraint(bakeGroup, instObject, e=True, rm=True)
-
-                    if objectScale:
-                        for scaleAttr in doubleAttrs:
-                            if scaleAttr == objectScale:
-                                pm.xform(instObject, s=(size[0], size[0], size[0]))
-                        for scaleAttr in vectorAttrs:
-                            if scaleAttr == objectScale:
-                                pm.xform(instObject, s=size)
-                    
-                    pm.xform(instObject, ztp=True, wd=True, ws=True, cp=True, p=1)
-                    pm.xform(instObject, ws=True, t=pos, a=True, wd=True)
-                    
-                    for attr in ['tx', 'ty', 'tz', 'rx', 'ry', 'rz', 'sx', 'sy', 'sz', 'v']:
-                        pm.setKeyframe(instObject.name(), at=attr)
-                        
-                    
-                        
-        pm.xform(bakeGroup, a=True, t=(0,0,0))
-        pm.parent(instances, bakeGroup, a=True)
-        
-        # Cleanup invisible frame
-        for instObject in instances:
-            keys = pm.keyframe(instObject.name(), query=True)
-            for fr in keys:
-                for attr in ['sx', 'sy', 'sz', 'v']:
-                    if fr+1 not in keys:
-                        pm.setKeyframe(instObject.name(), at=attr, t=fr+1, v=0)
-                    if fr-1 not in keys:
-                        pm.setKeyframe(instObject.name(), at=attr, t=fr-1, v=0)
+def benchmarkStartup(path=None, repeat=10, target=0.05):
+    # Time sourcing the tool without its dialog, and count scene queries issued while doing it
+    path = path or globals().get('__file__', '')
+    path = os.path.splitext(path)[0] + '.py'
+    with open(path, 'r') as f:
+        source = f.read()
+    
+    queries = [0]
+    def counted(command):
+        def countedCommand(*args, **kwargs):
+            queries[0] += 1
+            return command(*args, **kwargs)
+        return countedCommand
+    
+    patched = []
+    for module, name in [(cmds, 'ls'), (cmds, 'playbackOptions'), (pm, 'ls'), (pm, 'playbackOptions')]:
+        command = getattr(module, name)
+        patched.append((module, name, command))
+        setattr(module, name, counted(command))
+    
+    try:
+        startTime = time.time()
+        for i in range(repeat):
+            exec(compile(source, path, 'exec'), {'__name__': 'nparticleToMesh', '__file__': path})
+        elapsed = (time.time() - startTime) / repeat
+    finally:
+        for module, name, command in patched:
+            setattr(module, name, command)
+    
+    print("Startup %.4f seconds (target %.4f), %d scene queries" %(elapsed, target, queries[0]))
+    if elapsed > target or queries[0]:
+        raise AssertionError("Sourcing the tool should not query the scene and stay under %.4f seconds" %target)
+    return elapsed
 
+def benchmarkPointMatrixMult(count=10000):
+    points = [(i*0.1, i*0.2, i*0.3) for i in range(count)]
+    matrix = [[0, 1, 0, 0], [-2, 0, 0, 0], [0, 0, 3, 0], [10, 20, 30, 1]]
+    
+    startTime = time.time()
+    for point in points:
+        melPointMatrixMult(point, matrix)
+    melTime = time.time() - startTime
+    
+    startTime = time.time()
+    transformPoints(points, matrix)
+    arrayTime = time.time() - startTime
+    
+    print("%d points | mel %.4fs | %s %.4fs | %.1fx" %(
+        count, melTime, "numpy" if np is not None else "python", arrayTime, melTime/max(arrayTime, 1e-9)))
+    return melTime, arrayTime
+
+def benchmarkWorkers(particles=20000, frames=16, workers=(1, 2, 4, 8)):
+    # Time both worker stages on synthetic frames, processing and encoding then key reduction, no scene needed
+    settings = {
+        'objects': ['obj'], 'rotationType': None, 'defaultRotationType': 1,
+        'rotationOrder': 'xyz', 'rotationRadians': False,
+    }
+    raw = {
+        'count': particles,
+        'ids': [float(i) for i in range(particles)],
+        'positions': [(i*0.1, i*0.2, i*0.3) for i in range(particles)],
+        'rotations': [(0,0,0)] * particles,
+        'scales': [1.0] * particles,
+        'indices': [0.0] * particles,
+        'aimDirections': [(math.sin(i), math.cos(i), 0.5) for i in range(particles)],
+        'aimPositions': [(0,0,0)] * particles,
+        'aimAxes': [(1,0,0)] * particles,
+        'aimUpAxes': [(0,1,0)] * particles,
+        'aimWorldUps': [(0,1,0)] * particles,
+        'rotationTypes': [1.0] * particles,
+        'matrix': [[1,0,0,0], [0,1,0,0], [0,0,1,0], [0,0,0,1]],
+    }
+    raws = [raw] * frames
+    
+    results = []
+    for count in workers:
+        pool = WorkerPool(count)
+        startTime = time.time()
+        processed = pool.map(lambda r: processFrame(r, settings), raws)
+        pool.map(lambda d: encodeFrame(0, d), processed)
+        reduceKeys(processed, pool)
+        elapsed = time.time() - startTime
+        pool.close()
+        results.append((count, elapsed))
+    
+    baseTime = results[0][1]
+    print("%d particles x %d frames (%s)" %(particles, frames, "numpy" if np is not None else "python"))
+    for count, elapsed in results:
+        print("%2d workers | %.3fs | %.2fx" %(count, elapsed, baseTime/max(elapsed, 1e-9)))
+    return results
+
+def benchmarkKeying(particles=200, frames=50):
+    # Keying on the main thread, setKeyframe per key against CurveKeyWriter, on temporary transforms removed afterwards
+    results = []
+    for name in ['setKeyframe', 'addKeys']:
+        nodes = [cmds.createNode('transform', name='benchmarkKeying%d' %i, skipSelect=True) for i in range(particles)]
+        try:
+            startTime = time.time()
+            keys = CurveKeyWriter(0, frames)
+            for fr in range(frames):
+                for node in nodes:
+                    for attr in KEY_ATTRS:
+                        if name == 'addKeys':
+                            keys.add(node, attr, fr, fr * 0.1)
+                        else:
+                            cmds.setKeyframe(node, at=attr, t=fr, v=fr * 0.1, itt='linear', ott='linear')
+            keys.flush()
+            results.append((name, time.time() - startTime))
+        finally:
+            cmds.delete(nodes)
+    
+    baseTime = results[0][1]
+    print("%d particles x %d frames x %d channels" %(particles, frames, len(KEY_ATTRS)))
+    for name, elapsed in results:
+        print("%-12s | %.3fs | %.1fx" %(name, elapsed, baseTime/max(elapsed, 1e-9)))
+    return results
 
 ### UI
 
@@ -243,9 +1367,23 @@ class ParticleInstanceBaker(QDialog):
         for w in [self.bakeFrameLabel, self.bakeFrameStart, self.bakeFrameDiv, self.bakeFrameEnd]:
             self.bakeFrameLayout.addWidget(w)
 
+        self.cacheCheck = QCheckBox("Write Instance Cache instead of Transforms")
+        self.resumeCheck = QCheckBox("Resumable Bake (checkpoint to Cache Dir)")
+        self.cacheDirLayout = QHBoxLayout()
+        self.cacheDirLabel = QLabel('Cache Dir :')
+        self.cacheDir = QLineEdit()
+        for w in [self.cacheDirLabel, self.cacheDir]:
+            self.cacheDirLayout.addWidget(w)
+
         self.bakeButton = QPushButton("Bake Selected nParticles")
+        
+        self.progressLayout = QHBoxLayout()
+        self.progressBar = QProgressBar()
+        self.cancelButton = QPushButton("Cancel")
+        for w in [self.progressBar, self.cancelButton]:
+            self.progressLayout.addWidget(w)
 
-        for w in (self.bakeFrameLayout, self.bakeButton):
+        for w in (self.bakeFrameLayout, self.cacheCheck, self.resumeCheck, self.cacheDirLayout, self.bakeButton, self.progressLayout):
             try:
                 self.masterLayout.addWidget(w)
             except:
@@ -254,6 +1392,7 @@ class ParticleInstanceBaker(QDialog):
 
     def connectSignal(self):
         self.bakeButton.clicked.connect(self.bakeParticles)
+        self.cancelButton.clicked.connect(self.cancelBake)
 
     def initUI(self):
         self.bakeFrameLabel.setMaximumWidth(70)
@@ -267,6 +1406,17 @@ class ParticleInstanceBaker(QDialog):
         
         self.bakeFrameStart.setValue(int(pm.playbackOptions(q=True, ast=True)))
         self.bakeFrameEnd.setValue(int(pm.playbackOptions(q=True, aet=True)))
+        
+        self.cacheDirLabel.setMaximumWidth(70)
+        self.cacheDirLabel.setMinimumWidth(70)
+        self.cacheDir.setText(pm.workspace(q=True, rd=True)+'data')
+        self.cacheDir.setToolTip("Instance cache and bake checkpoint folder")
+        
+        self.resumeCheck.setToolTip("Write a small checkpoint after every chunk so a cancelled bake can be continued")
+        
+        self.progressBar.setValue(0)
+        self.cancelButton.setEnabled(False)
+        self.cancelled = False
 
     def bakeParticles(self):
         selectedParticles = []
@@ -277,12 +1427,39 @@ class ParticleInstanceBaker(QDialog):
                 if oType == 'nParticle':
                     selectedParticles.append(s)
 
-        bakeNParticles(
-            nParticles=selectedParticles,
-            startFrame= int(self.bakeFrameStart.text()),
-            endFrame= int(self.bakeFrameEnd.text())
-        )
+        cacheDir = self.cacheDir.text()
+        useDir = self.cacheCheck.isChecked() or self.resumeCheck.isChecked()
+        if useDir and cacheDir and not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+        
+        self.cancelled = False
+        self.bakeButton.setEnabled(False)
+        self.cancelButton.setEnabled(True)
+        self.progressBar.setValue(0)
+        try:
+            bakeNParticles(
+                nParticles=selectedParticles,
+                startFrame= int(self.bakeFrameStart.text()),
+                endFrame= int(self.bakeFrameEnd.text()),
+                cacheDir= cacheDir if self.cacheCheck.isChecked() else None,
+                checkpointDir= cacheDir if self.resumeCheck.isChecked() and cacheDir else None,
+                progress= self.bakeProgress
+            )
+        finally:
+            self.bakeButton.setEnabled(True)
+            self.cancelButton.setEnabled(False)
+            
+    def bakeProgress(self, done, total):
+        # Called between chunks, keeps the dialog responsive so cancel can be clicked
+        self.progressBar.setMaximum(total)
+        self.progressBar.setValue(done)
+        QApplication.processEvents()
+        return not self.cancelled
+        
+    def cancelBake(self):
+        self.cancelled = True
         
 
-w = ParticleInstanceBaker()
-w.show()
\ No newline at end of file
+if __name__ == '__main__':
+    w = ParticleInstanceBaker()
+    w.show()
\ No newline at end of file
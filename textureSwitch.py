@@ -5,6 +5,7 @@
 # and store the connection data in a json file that can be used to restore it later
 #
 # Install:
+# - Copy colorizeCommon.py to a folder in the maya script path (e.g. Documents/maya/scripts)
 # - Copy and paste content to maya script editor, and run it from there
 # - Or use type "execfile('[path to this file]')" in script editor and run it
 #
@@ -18,10 +19,20 @@
 
 import os
 import json
+import hashlib
 import traceback
 from PySide2.QtWidgets import QApplication, QDialog, QVBoxLayout, QPushButton, QCheckBox, QListWidget, QProgressBar
+from maya import cmds
+import maya.api.OpenMaya as om2
 import pymel.core as pm
 
+from colorizeCommon import getFileTexturePath, getTextureColor, textureColorCache, ShadingGraphIndex
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 def undoOn(function):
     def funcCall(*args,**kwargs):
         result = None
@@ -37,6 +48,136 @@ def undoOn(function):
         return result
     return funcCall
 
+def faceWeights(points, counts, vertexIds, uvCounts, uvIds, uArray, vArray):
+    # Area and uv bounding box center of every face with uvs, faces are triangulated as a fan
+    if np is not None:
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        counts = np.asarray(counts, dtype=np.int64)
+        vertexIds = np.asarray(vertexIds, dtype=np.int64)
+        offsets = np.cumsum(counts) - counts
+        faces = np.repeat(np.arange(len(counts)), counts)
+        local = np.arange(len(vertexIds)) - offsets[faces]
+        triangles = np.nonzero((local >= 1) & (local <= counts[faces] - 2))[0]
+        p0 = points[vertexIds[offsets[faces[triangles]]]]
+        edge1 = points[vertexIds[triangles]] - p0
+        edge2 = points[vertexIds[triangles + 1]] - p0
+        triangleAreas = np.linalg.norm(np.cross(edge1, edge2), axis=1) / 2
+        areas = np.bincount(faces[triangles], weights=triangleAreas, minlength=len(counts))
+        
+        uvCounts = np.asarray(uvCounts, dtype=np.int64)
+        hasUV = uvCounts > 0
+        if not hasUV.any():
+            return areas[:0], areas[:0], areas[:0]
+        uvIds = np.asarray(uvIds, dtype=np.int64)
+        u = np.asarray(uArray, dtype=np.float64)[uvIds]
+        v = np.asarray(vArray, dtype=np.float64)[uvIds]
+        # Faces without uvs have no entries, so the starts of the others delimit each face
+        starts = (np.cumsum(uvCounts) - uvCounts)[hasUV]
+        uCenter = (np.minimum.reduceat(u, starts) + np.maximum.reduceat(u, starts)) / 2
+        vCenter = (np.minimum.reduceat(v, starts) + np.maximum.reduceat(v, starts)) / 2
+        return areas[hasUV], uCenter, vCenter
+    
+    areas, uCenter, vCenter = [], [], []
+    offset = uvOffset = 0
+    for count, uvCount in zip(counts, uvCounts):
+        if uvCount:
+            face = [points[i] for i in vertexIds[offset:offset+count]]
+            area = 0.0
+            for k in range(1, count-1):
+                edge1 = [a - b for a, b in zip(face[k], face[0])]
+                edge2 = [a - b for a, b in zip(face[k+1], face[0])]
+                c = (edge1[1]*edge2[2] - edge1[2]*edge2[1], edge1[2]*edge2[0] - edge1[0]*edge2[2], edge1[0]*edge2[1] - edge1[1]*edge2[0])
+                area += (c[0]*c[0] + c[1]*c[1] + c[2]*c[2]) ** .5 / 2
+            us = [uArray[i] for i in uvIds[uvOffset:uvOffset+uvCount]]
+            vs = [vArray[i] for i in uvIds[uvOffset:uvOffset+uvCount]]
+            areas.append(area)
+            uCenter.append((min(us) + max(us)) / 2)
+            vCenter.append((min(vs) + max(vs)) / 2)
+        offset += count
+        uvOffset += uvCount
+    return areas, uCenter, vCenter
+
+def getMeshPath(obj):
+    # Mesh shape under a transform, or the shape itself, intermediate shapes like *ShapeOrig are skipped
+    selection = om2.MSelectionList()
+    selection.add(obj)
+    dagPath = selection.getDagPath(0)
+    if dagPath.hasFn(om2.MFn.kTransform):
+        for i in range(dagPath.numberOfShapesDirectlyBelow()):
+            shapePath = om2.MDagPath(dagPath)
+            shapePath.extendToShape(i)
+            if shapePath.hasFn(om2.MFn.kMesh) and not om2.MFnDagNode(shapePath).isIntermediateObject:
+                return shapePath
+        return None
+    if dagPath.hasFn(om2.MFn.kMesh) and not om2.MFnDagNode(dagPath).isIntermediateObject:
+        return dagPath
+    return None
+
+def getFaceWeights(objects):
+    # Face weights of every mesh read from the MFnMesh arrays, the selection is never touched
+    areas, uCenter, vCenter = [], [], []
+    for obj in objects:
+        dagPath = getMeshPath(obj)
+        if dagPath is None:
+            continue
+        fnMesh = om2.MFnMesh(dagPath)
+        
+        points = [(p.x, p.y, p.z) for p in fnMesh.getPoints(om2.MSpace.kWorld)]
+        counts, vertexIds = fnMesh.getVertices()
+        uvCounts, uvIds = fnMesh.getAssignedUVs()
+        uArray, vArray = fnMesh.getUVs()
+        weights = faceWeights(points, list(counts), list(vertexIds), list(uvCounts), list(uvIds), list(uArray), list(vArray))
+        for values, weight in zip((areas, uCenter, vCenter), weights):
+            values.extend(weight)
+    return areas, uCenter, vCenter
+
+def getPlacementValues(node):
+    # Color balance, color management and uv placement of the file node, all change what colorAtPoint returns
+    attrs = ['colorGain', 'colorOffset', 'alphaGain', 'alphaOffset', 'invert', 'defaultColor', 'alphaIsLuminance', 'colorSpace']
+    # These only exist on the file node of newer Maya versions
+    attrs += [attr for attr in ['exposure', 'ignoreColorSpaceFileRules'] if cmds.attributeQuery(attr, node=node, exists=True)]
+    values = [cmds.getAttr(node + '.' + attr) for attr in attrs]
+    values.append([cmds.colorManagementPrefs(q=True, cmEnabled=True), cmds.colorManagementPrefs(q=True, renderingSpaceName=True)])
+    for place in cmds.listConnections(node + '.uvCoord', s=True, d=False, type='place2dTexture') or []:
+        for attr in ['coverage', 'translateFrame', 'rotateFrame', 'mirrorU', 'mirrorV', 'wrapU', 'wrapV', 
+                     'repeatUV', 'offset', 'rotateUV', 'noiseUV']:
+            values.append(cmds.getAttr(place + '.' + attr))
+    return json.loads(json.dumps(values))
+
+def getDominantColor(source, weights, cache=None):
+    # Area weighted mean of the texture at every face uv center, looked up in a single colorAtPoint call
+    areas, uCenter, vCenter = weights
+    if np is not None:
+        areas, uCenter, vCenter = [np.asarray(w, dtype=np.float64) for w in weights]
+    totalArea = float(sum(areas) if np is None else areas.sum())
+    if not totalArea:
+        return None
+    
+    node = source.split('.')[0]
+    path = getFileTexturePath(node) if cache else None
+    key = None
+    if path:
+        # Same image and same faces give the same color
+        if np is not None:
+            digest = hashlib.sha1(np.stack([areas, uCenter, vCenter]).tobytes()).hexdigest()
+        else:
+            digest = hashlib.sha1(json.dumps([areas, uCenter, vCenter]).encode('utf-8')).hexdigest()
+        key = cache.key(path, dominant=digest, plug=source.split('.', 1)[-1], placement=getPlacementValues(node))
+        rgba = cache.get(key)
+        if rgba is not None:
+            return rgba
+    
+    if np is not None:
+        values = cmds.colorAtPoint(source, o='RGBA', u=uCenter.tolist(), v=vCenter.tolist())
+        rgba = (areas.dot(np.asarray(values, dtype=np.float64).reshape(-1, 4)) / totalArea).tolist()
+    else:
+        values = cmds.colorAtPoint(source, o='RGBA', u=uCenter, v=vCenter)
+        rgba = [sum(area * value for area, value in zip(areas, values[c::4])) / totalArea for c in range(4)]
+    
+    if key:
+        cache.set(key, rgba)
+    return rgba
+
 class ColorizeTool(QDialog):
     def __init__(self):
         super(ColorizeTool, self).__init__(self.getAppWindow())
@@ -69,7 +210,7 @@ class ColorizeTool(QDialog):
         
         self.getObjectButton = QPushButton("Get Selected Objects")
         self.checkHierarchy = QCheckBox("Check Descendants")
-        self.checkDominant = QCheckBox("Get Dominant Color (slow)")
+        self.checkDominant = QCheckBox("Get Dominant Color")
         self.progressBar = QProgressBar()
         self.objectListWidget = QListWidget()
         self.colorizeButton = QPushButton("Colorize")
@@ -143,100 +284,61 @@ class ColorizeTool(QDialog):
     def processData(self):
         self.shaderData = {}
         shadingGroup = []
+        textureColorCache.load(force=True)
         
         processed = 0
         self.getObjectButton.setVisible(False)
         self.progressBar.setVisible(True)
         self.progressBar.reset()
 
-        selection = pm.ls(sl=1)
-
+        shadingEngines = ShadingGraphIndex.getShadingEngines(self.meshes)
         for obj in self.meshes:
-            shadingEngines = pm.listConnections(obj.getShape(), type='shadingEngine')
-            if not shadingEngines:
+            objShadingGroup = shadingEngines.get(obj)
+            if not objShadingGroup:
                 continue
             
-            objShadingGroup = shadingEngines[0]
-            if objShadingGroup not in shadingGroup:
+            if objShadingGroup not in self.shaderData:
                 shadingGroup.append(objShadingGroup)
-            
-            currentData = self.shaderData.get(objShadingGroup.name(), {'objects':[]})
-            currentData['objects'] += [obj.name()]
-            self.shaderData[objShadingGroup.name()] = currentData
-
+                self.shaderData[objShadingGroup] = {'objects':[]}
+            self.shaderData[objShadingGroup]['objects'].append(obj.name())
+        
+        index = ShadingGraphIndex(shadingGroup)
+        averageColors = {}
         for sg in shadingGroup:
-            currentData = self.shaderData[sg.name()]
+            currentData = self.shaderData[sg]
             textureData = currentData.get('textures', [])
             colorData = currentData.get('colors', [])
-            
-            sgConnections = pm.listHistory(sg)
-            sgTextures = pm.ls(sgConnections, textures=True)
-            sgShaders = pm.ls(sgConnections, materials=True)
+            sdCons = set(textureData)
 
             if self.checkDominant.isChecked():
-                totalArea = 0
-                weightInfo = []
-                for o in currentData['objects']:
-                    processed += 1
-                    self.progressBar.setValue(float(processed)/len(self.meshes) * 100)
-                    
-                    faceCount = pm.polyEvaluate(o, f=True)
-                    for faceId in range(faceCount):
-                        face = "%s.f[%d]" %(o, faceId)
-                        pm.select(face)
-
-                        area = pm.polyEvaluate(face, faceArea=True)[0]
-                        bb = pm.polyEvaluate(boundingBoxComponent2d=True)
-
-                        totalArea += area
-                        x, y = ((bb[0][0]+bb[1][0])/2, (bb[0][1]+bb[1][1])/2)
-                        weightInfo.append([area, x, y])
+                processed += len(currentData['objects'])
+                self.progressBar.setValue(float(processed)/len(self.meshes) * 100)
+                weights = getFaceWeights(currentData['objects'])
+            else:
+                processed += 1
+                self.progressBar.setValue(float(processed)/len(shadingGroup) * 100)
             
-            for texture in sgTextures:
-                connections = pm.listConnections(texture, connections=True, destination=True, plugs=True)
+            for sdCon in index.getTextureConnections(sg):
+                if sdCon in sdCons:
+                    continue
+                source = sdCon[0]
                 
-                for connection in connections:
-                    source = connection[0]
-                    destination = connection[1]
-                    if destination.node() in sgShaders:
-                        sdCon = (source.name(), destination.name())
-                        if sdCon not in textureData:
-                            rgba = [0,0,0,0]
-
-                            if self.checkDominant.isChecked():
-                                for area, x, y in weightInfo:
-                                    r,g,b,a = pm.colorAtPoint(source, o='RGBA', u=x, v=y)
-
-                                    weight = area/totalArea
-                                    rgba[0] += r*weight
-                                    rgba[1] += g*weight
-                                    rgba[2] += b*weight
-                                    rgba[3] += a*weight
-                            else:
-                                processed += 1
-                                self.progressBar.setValue(float(processed)/len(shadingGroup) * 100)
-                                maxSample = 10
-                                
-                                for u in range(maxSample):
-                                    for v in range(maxSample):
-                                        x = float(u)/maxSample
-                                        y = float(v)/maxSample
-                                        total = maxSample*maxSample
-                                        
-                                        r,g,b,a = pm.colorAtPoint(source, o='RGBA', u=x, v=y)
-                                        
-                                        rgba[0] += r/total
-                                        rgba[1] += g/total
-                                        rgba[2] += b/total
-                                        rgba[3] += a/total
+                if self.checkDominant.isChecked():
+                    rgba = getDominantColor(source, weights, cache=textureColorCache) or [0,0,0,0]
+                else:
+                    # Textures shared by several shading groups are averaged once
+                    if source not in averageColors:
+                        averageColors[source] = getTextureColor(source, cache=textureColorCache)
+                    rgba = list(averageColors[source])
 
-                            colorData += [(source.name(), rgba)]
-                            textureData += [sdCon]
+                colorData += [(source, rgba)]
+                textureData += [sdCon]
+                sdCons.add(sdCon)
 
             currentData['textures'] = textureData
             currentData['colors'] = colorData
         
-        pm.select(selection)
+        textureColorCache.save()
         if self.shaderData:
             jsonOutput = self.getJsonFile()
             with open(jsonOutput, "w+") as f:
@@ -254,8 +356,9 @@ class ColorizeTool(QDialog):
             with open(jsonOutput, "r+") as f:
                 self.shaderData = json.load(f)
             for k, v in self.shaderData.items():
+                colors = dict((c[0], c[1]) for c in v['colors'])
                 for i in v['textures']:
-                    rgba = next((c[1] for c in v['colors'] if c[0] == i[0]), None)
+                    rgba = colors.get(i[0])
                     if rgba:
                         # pump up saturation
                         saturation = .8